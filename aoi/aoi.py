@@ -16,7 +16,9 @@ along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import sys
 import math
+import collections
 import numpy
 from PyQt4 import QtCore, QtGui
 
@@ -26,6 +28,27 @@ from libopensesame import item, exceptions
 from libqtopensesame import qtplugin
 from libqtopensesame.ui import sketchpad_widget_ui
 
+# helper library, which lives next to this file
+_plugindir = os.path.dirname(os.path.abspath(__file__))
+if _plugindir not in sys.path:
+	sys.path.append(_plugindir)
+import libaoi
+
+# the longest time (in milliseconds) that the trial loop waits for a
+# tracker event, before it checks the deadline again
+POLLINTERVAL = 1
+
+# pixmaps of a single grid cell, by grid size and colour, which are tiled
+# over the AOI preview
+_gridtiles = {}
+
+# the pixmaps of sketchpad images, gabor patches, and noise patches in the
+# AOI preview, keyed by file path and modification time, or by patch
+# parameters; only the most recently used ones that fit the memory budget
+# (in bytes) are kept
+PIXMAPCACHESIZE = 64 * 1024**2
+_pixmapcache = libaoi.canvascache(PIXMAPCACHESIZE)
+
 def pos2psychopos(pos, dispsize):
 
 	"""Returns a converted position tuple (x,y) (internal use)
@@ -85,6 +108,7 @@ class aoi(item.item):
 		self.spname = u'welcome'
 		self.timeout = 5000
 		self.aoiname = u"AOI_0"
+		self.aoishape = u'rectangle'
 		self.aoidict = {}
 		self.aoidictstr = str(self.aoidict)
 		self.x = 0
@@ -92,8 +116,27 @@ class aoi(item.item):
 		self.w = 200
 		self.h = 100
 		self.gridsize = 10
+		self.aoiindex = u'grid'
+		self.rasterscale = 1
+		self.aoievents = u'fixations'
+		self.aoimargin = 10
+		self.aoidelay = 0
+		self.stopaoi = u''
+		self.fixdetect = u'tracker'
+		self.fixvelocity = 1000
+		self.fixdispersion = 50
+		self.fixmindur = 100
+		self.heatmap = u'no'
+		self.heatmapcell = 10
+		self.heatmapsigma = 30
+		self.outputmode = u'variables'
+		self.templatename = u''
+		self.usetemplate = u''
+		self.templatex = 0
+		self.templatey = 0
+		self.templatescale = 1
 		self.description = \
-			u"Define areas of interest (AOIs) with a rectangle shape"
+			u"Define areas of interest (AOIs) with a rectangle, ellipse, or polygon shape"
 		item.item.__init__(self, name, experiment, string)
 		
 		if hasattr(self.experiment, "aoidict"):
@@ -111,6 +154,9 @@ class aoi(item.item):
 		True
 		"""
 		
+		# sets count_<name>, which is the trial key of the column stores
+		item.item.prepare(self)
+		
 		# check for eyetracker
 		if not hasattr(self.experiment, "eyetracker"):
 			raise exceptions.runtime_error( \
@@ -122,32 +168,132 @@ class aoi(item.item):
 		else:
 			self.notimeout = True
 		
-		# canvas
-		self.cv = openexp.canvas.canvas(self.experiment)
-		self.cv.copy(self.experiment.items[self.get(u'spname')].canvas)
+		# canvas; prepared copies of sketchpads are cached across trials
+		# (and shared with the other AOI items), for as long as the
+		# sketchpad itself is not prepared again
+		if not hasattr(self.experiment, u'aoicanvascache'):
+			self.experiment.aoicanvascache = libaoi.canvascache( \
+				self.get_check(u'canvas_cache_mb', 256) * 1024**2)
+		w, h = self.experiment.resolution()
+		source = self.experiment.items[self.get(u'spname')].canvas
+		self.cv = self.experiment.aoicanvascache.get( \
+			(u'canvas', self.get(u'spname')), source)
+		if self.cv is None:
+			self.cv = openexp.canvas.canvas(self.experiment)
+			self.cv.copy(source)
+			self.experiment.aoicanvascache.put( \
+				(u'canvas', self.get(u'spname')), source, self.cv, 4*w*h)
 		
 		# keyboard
 		self.kb = keyboard(self.experiment, keylist=None, timeout=1)
 		
-		# string to dict
-		exec("self.aoidict = %s" % self.get("aoidictstr"))
-		
-		# create numpy arrays (for faster processing)
-		blnkarray = numpy.array(numpy.zeros(len(self.aoidict)),dtype=numpy.int)
-		self._lx = numpy.array(blnkarray, copy=True) # left x border
-		self._rx = numpy.array(blnkarray, copy=True) # right x border
-		self._ty = numpy.array(blnkarray, copy=True) # top y border
-		self._by = numpy.array(blnkarray, copy=True) # bottom y border
-		self._namelist = numpy.array(self.aoidict.keys())
+		# AOI arrays (for faster processing), which are compiled once for
+		# every AOI definition string, and shared by all trials and items
+		# of the experiment
+		if not hasattr(self.experiment, u'aoisets'):
+			self.experiment.aoisets = collections.OrderedDict()
+		try:
+			if self.get(u'usetemplate') == u'':
+				self.aois = libaoi.compile_aoiset(self.get(u'aoidictstr'), \
+					cache=self.experiment.aoisets)
+				placement = None
+			else:
+				# the AOIs of a template, scaled around the display centre
+				# and shifted, e.g. by loop variables
+				self.aois = self.template(self.get(u'usetemplate'))
+				placement = [float(self.get(key)) for key in \
+					[u'templatex', u'templatey', u'templatescale']]
+		except ValueError as e:
+			raise exceptions.runtime_error(u"Invalid AOI: %s" % e)
+		self._namelist = self.aois.names
 		self._aoicount = numpy.zeros(len(self._namelist))
 		self._notaoicount = 0
+		# the metrics are allocated once for every AOI set, and cleared at
+		# the start of every trial
+		if not hasattr(self.aois, u'metrics'):
+			self.aois.metrics = libaoi.aoimetrics(len(self.aois))
+		self.metrics = self.aois.metrics
 		
-		for aoinr in range(0,len(self._namelist)):
-			x, y, w, h = self.aoidict[self._namelist[aoinr]]
-			self._lx[aoinr] = x
-			self._rx[aoinr] = x + w
-			self._ty[aoinr] = y
-			self._by[aoinr] = y + h
+		# a duration-weighted fixation density grid for this trial
+		if self.get(u'heatmap') == u'yes':
+			self.density = libaoi.heatmap(self.experiment.resolution(), \
+				cellsize=self.get(u'heatmapcell'))
+		else:
+			self.density = None
+		self.fixpos = None
+		
+		# per-AOI metrics can go to column stores next to the logfile,
+		# rather than into a variable per AOI and metric
+		if self.get(u'outputmode') == u'column store':
+			self.store = self.columnstore(u'store')
+			self.transitionstore = self.columnstore(u'transitions')
+			self.samplestore = self.columnstore(u'samples')
+		else:
+			self.store = None
+		
+		# hit testing: either every AOI is tested against every fixation,
+		# or a spatial index limits the tests to the AOIs near a fixation;
+		# indexes are kept with the (cached) AOI set
+		key = self.get(u'aoiindex'), self.experiment.resolution(), \
+			self.get(u'rasterscale')
+		if key in self.aois.indexes:
+			self.index = self.aois.indexes[key]
+		elif self.get(u'aoiindex') == u'grid':
+			self.index = libaoi.gridindex(self.aois, \
+				self.experiment.resolution())
+		elif self.get(u'aoiindex') == u'raster':
+			self.index = libaoi.rasterindex(self.aois, \
+				self.experiment.resolution(), scale=self.get(u'rasterscale'))
+		elif self.get(u'aoiindex') == u'none':
+			self.index = libaoi.bruteforce(self.aois)
+		else:
+			raise exceptions.runtime_error( \
+				u"Unknown AOI index '%s'" % self.get(u'aoiindex'))
+		self.aois.indexes[key] = self.index
+		# a placed template keeps its own coordinates and index, and gaze
+		# positions are mapped into them instead
+		if placement != None:
+			try:
+				self.index = libaoi.placedindex(self.index, *placement, \
+					origin=(w/2.0, h/2.0))
+			except ValueError as e:
+				raise exceptions.runtime_error(u"Invalid AOI: %s" % e)
+		
+		# AOI events: either fixations (as reported by the tracker's
+		# fixation detector), or enters and exits of every gaze sample
+		if self.get(u'aoievents') == u'gaze samples':
+			self.crossings = libaoi.crossingdetector(self.aois, self.index, \
+				margin=self.get(u'aoimargin'), delay=self.get(u'aoidelay'))
+		elif self.get(u'aoievents') == u'fixations':
+			self.crossings = None
+		else:
+			raise exceptions.runtime_error( \
+				u"Unknown AOI events '%s'" % self.get(u'aoievents'))
+		
+		# fixations are either detected by the tracker, or by a detector
+		# that runs on the raw samples; the tracker's fixation events can
+		# only be waited for, so that (as before) the timeout and key
+		# presses are only checked between them
+		fixdetect = self.get(u'fixdetect')
+		if fixdetect not in [u'tracker', u'I-VT', u'I-DT']:
+			raise exceptions.runtime_error( \
+				u"Unknown fixation detection '%s'" % fixdetect)
+		self.detector = None
+		if self.crossings != None:
+			pass
+		elif fixdetect == u'I-VT':
+			self.detector = libaoi.fixationdetector(libaoi.IVT, \
+				threshold=self.get(u'fixvelocity'), \
+				mindur=self.get(u'fixmindur'))
+		elif fixdetect == u'I-DT':
+			self.detector = libaoi.fixationdetector(libaoi.IDT, \
+				threshold=self.get(u'fixdispersion'), \
+				mindur=self.get(u'fixmindur'))
+		self.stopname = self.get(u'stopaoi')
+		if self.stopname != u'' and self.stopname not in self._namelist:
+			raise exceptions.runtime_error( \
+				u"The AOI '%s' that should end the trial does not exist" % \
+				self.stopname)
 				
 		return True
 	
@@ -160,52 +306,416 @@ class aoi(item.item):
 		True
 		"""
 		
-		stop = False
-		fixating = False
 		t0 = self.cv.show()
+		self.metrics.reset(t0)
+		if self.notimeout:
+			deadline = None
+		else:
+			deadline = t0 + self.get(u'timeout')
+		self.response = None
+		self.resptime = None
+		
+		# the built-in fixation detector and the AOI enters and exits run on
+		# the raw sample stream, which is collected by a sampler that polls
+		# on its own thread; enters and exits are detected on that thread
+		# as well; the tracker's own fixation events are waited for without
+		# a sampler, so that nothing else uses the tracker meanwhile
+		self.events = []
+		if self.crossings != None:
+			self.crossings.reset()
+			sampler = libaoi.gazesampler(self.experiment.eyetracker, \
+				self.experiment.time, callback=self.crossings.sample)
+			sampler.start()
+			events = self.crossings.events
+		elif self.detector != None:
+			self.detector.reset()
+			sampler = libaoi.gazesampler(self.experiment.eyetracker, \
+				self.experiment.time)
+			sampler.start()
+			events = libaoi.queue.Queue()
+		else:
+			sampler = None
+			events = libaoi.queue.Queue()
+		fixating = False
+		nsamples = 0
+		chunks = []
 		
+		# tracker events come in on a queue, so that the loop can wait for
+		# them, for a key press, and for the deadline at the same time
+		stop = False
 		while not stop:
 			
-			if not fixating:
-				# wait for fixation
-				ft0, (fx, fy) = self.experiment.eyetracker.wait_for_fixation_start()
-				fixating = True
-				
-				# check if fixpos is in an AOI
-				xina = (self._lx < fx) == (self._rx > fx) # fixation between x borders
-				yina = (self._by < fy) == (self._ty > fy) # fixation between y borders
-				self._aoicount[xina&yina] += 1 # add one to the count of every fixated AOI
-				
-				# if no AOI is hit
-				if sum(xina&yina) == 0:
-					self._notaoicount += 1
+			# the deadline
+			if deadline != None:
+				remaining = deadline - self.experiment.time()
+				if remaining <= 0:
+					break
 			else:
-				ft1, pos = self.experiment.eyetracker.wait_for_fixation_end()
-				fixating = False
+				remaining = POLLINTERVAL
+			
+			# the tracker's fixation events are waited for on this thread,
+			# so that the tracker is not used outside of the trial; this
+			# blocks until the next event, so that the deadline and the
+			# keyboard are only checked between events (the built-in
+			# detectors do not block); some trackers report their own
+			# clock, so events are timed on arrival, with the same clock
+			# as the trial's onset and the samples
+			if self.crossings == None and self.detector == None:
+				if fixating:
+					pos = self.experiment.eyetracker.wait_for_fixation_end()[1]
+					events.put((self.experiment.time(), u'fixation_end', pos))
+				else:
+					pos = self.experiment.eyetracker.wait_for_fixation_start()[1]
+					events.put((self.experiment.time(), u'fixation_start', \
+						pos))
+				fixating = not fixating
+			
+			# the built-in fixation detector runs on the newest samples
+			if self.detector != None:
+				chunk, nsamples = sampler.samples(nsamples)
+				chunks.append(chunk)
+				for event in self.detector.update(chunk):
+					events.put(event)
+			
+			# tracker events; in keypress mode, the keyboard is waited for
+			# instead
+			if self.get(u'timeout') == u'keypress':
+				wait = 0
+			else:
+				wait = min(remaining, POLLINTERVAL)
+			try:
+				if wait > 0:
+					event = events.get(timeout=wait/1000.0)
+				else:
+					event = events.get_nowait()
+				while not stop:
+					stop = self.handle_event(event, t0)
+					event = events.get_nowait()
+			except libaoi.queue.Empty:
+				pass
+			
+			# keep up with the sampler's ring buffer
+			if sampler != None and sampler.count - nsamples > \
+				sampler.capacity // 2:
+				chunk, nsamples = sampler.samples(nsamples)
+				chunks.append(chunk)
 			
 			# response
-			if self.timeout == 'keypress':
+			if self.get(u'timeout') == u'keypress' and not stop:
 				response, t1 = self.kb.get_key()
-				resptime = t1-t0
-				stop = True
-
-			# timeout
-			else:
-				if self.experiment.time() - t0 > self.timeout and not self.notimeout:
-					response = None
-					resptime = None
+				if response != None:
+					self.response = response
+					self.resptime = t1-t0
 					stop = True
 		
-		# handle variables
-		for aoi in range(0,len(self._namelist)):
-			varname = u'fixcount_' + self._namelist[aoi]
-			self.experiment.set(varname,self._aoicount[aoi])
-		self.experiment.set(u'fixcount_notAOI', self._notaoicount)
-		self.experiment.set(u'response', response)
-		self.experiment.set(u'response_time', resptime)
+		# a fixation that is still going on counts until the end of the
+		# trial
+		self.add_heat(self.experiment.time())
+		self.metrics.fixation_end(self.experiment.time())
+		
+		# all samples of this trial, as (timestamp, x, y) rows
+		if sampler == None:
+			self.samples = None
+		else:
+			sampler.stop()
+			chunks.append(sampler.samples(nsamples)[0])
+			self.samples = numpy.concatenate(chunks)
+		
+		# the first time at which gaze samples entered every AOI
+		firstenter = {}
+		for t, kind, name in self.events:
+			if kind == u'enter' and name not in firstenter:
+				firstenter[name] = t-t0
+		
+		# handle variables; no fixations are detected in gaze samples mode,
+		# so that only the first enters are logged there
+		if self.store != None:
+			self.store_metrics(firstenter)
+		elif self.crossings != None:
+			for name in self._namelist:
+				self.experiment.set(u'firstenter_' + name, \
+					firstenter.get(name, None))
+		else:
+			for aoi in range(0,len(self._namelist)):
+				varname = u'fixcount_' + self._namelist[aoi]
+				self.experiment.set(varname,self._aoicount[aoi])
+			self.experiment.set(u'fixcount_notAOI', self._notaoicount)
+			for aoi in range(0,len(self._namelist)):
+				name = self._namelist[aoi]
+				self.experiment.set(u'dwell_' + name, self.metrics.dwell[aoi])
+				self.experiment.set(u'revisits_' + name, self.metrics.revisits[aoi])
+				# AOIs that were never fixated have no first fixation
+				if numpy.isnan(self.metrics.firstfix[aoi]):
+					self.experiment.set(u'firstfix_' + name, None)
+					self.experiment.set(u'firstfixdur_' + name, None)
+				else:
+					self.experiment.set(u'firstfix_' + name, \
+						self.metrics.firstfix[aoi])
+					self.experiment.set(u'firstfixdur_' + name, \
+						self.metrics.firstfixdur[aoi])
+			# only the transitions that occurred, as (from, to, count)
+			# triples of AOI names
+			names = list(self._namelist) + [u'notAOI']
+			fromaoi, toaoi, counts = self.metrics.transition_counts()
+			self.experiment.set(u'aoi_transitions', str([(names[a], \
+				names[b], int(n)) for a, b, n in zip(fromaoi, toaoi, counts)]))
+		self.experiment.set(u'response', self.response)
+		self.experiment.set(u'response_time', self.resptime)
+		
+		# the heatmap is smoothed once, added to those of earlier trials with
+		# the same sketchpad, and saved next to the logfile
+		if self.density != None:
+			self.save_heatmap()
 		
 		return True
+	
+	def add_heat(self, t):
 		
+		"""
+		Adds the current fixation, if any, to the heatmap
+		
+		Arguments:
+		t		--	the end time of the fixation
+		"""
+		
+		if self.density != None and self.fixpos != None and \
+			self.metrics.onset != None:
+			fx, fy = self.fixpos
+			self.density.add(fx, fy, t - self.metrics.onset)
+		self.fixpos = None
+	
+	def save_heatmap(self):
+		
+		"""Smooths the trial's heatmap, and saves the sum of the heatmaps of
+		all of the item's trials with the sketchpad"""
+		
+		sigma = self.get(u'heatmapsigma')
+		spname = self.get(u'spname')
+		if not hasattr(self.experiment, u'heatmaps'):
+			self.experiment.heatmaps = {}
+		key = self.name, spname
+		if key in self.experiment.heatmaps:
+			density, trials = self.experiment.heatmaps[key]
+		else:
+			density, trials = numpy.zeros(self.density.grid.shape), 0
+		density += self.density.smoothed(sigma)
+		trials += 1
+		self.experiment.heatmaps[key] = density, trials
+		path = os.path.splitext(self.experiment.logfile)[0] + \
+			u'_%s_heatmap_%s.npz' % (self.name, spname)
+		libaoi.save_heatmap(path, density, self.density.resolution, \
+			self.density.cellsize, sigma, trials)
+		self.density.clear()
+	
+	def template(self, name):
+		
+		"""
+		Returns the AOIs of a template, i.e. of the aoi item with that
+		template name
+		
+		Arguments:
+		name		--	the template name
+		
+		Returns:
+		A libaoi.aoiset, which is compiled once for the experiment
+		"""
+		
+		# the templates of all aoi items are collected once
+		if not hasattr(self.experiment, u'aoitemplates'):
+			templates = {}
+			for entry in self.experiment.items.values():
+				if getattr(entry, u'item_type', None) != u'aoi' or \
+					entry.get(u'templatename') == u'':
+					continue
+				if entry.get(u'templatename') in templates:
+					raise exceptions.runtime_error( \
+						u"AOI template '%s' is defined by more than one item" \
+						% entry.get(u'templatename'))
+				templates[entry.get(u'templatename')] = entry.get(u'aoidictstr')
+			self.experiment.aoitemplates = templates
+		if name not in self.experiment.aoitemplates:
+			raise exceptions.runtime_error( \
+				u"Unknown AOI template '%s'" % name)
+		
+		return libaoi.compile_aoiset(self.experiment.aoitemplates[name], \
+			cache=self.experiment.aoisets)
+	
+	def columnstore(self, kind):
+		
+		"""
+		Returns one of the item's column stores, which are kept open by the
+		experiment
+		
+		Arguments:
+		kind		--	u'store' for the per-AOI metrics,
+					u'transitions' for the transition counts, or
+					u'samples' for the raw gaze samples
+		
+		Returns:
+		A libaoi.columnstore
+		"""
+		
+		path = os.path.splitext(self.experiment.logfile)[0] + \
+			u'_%s_%s' % (self.name, kind)
+		if not hasattr(self.experiment, u'aoicolumnstores'):
+			self.experiment.aoicolumnstores = {}
+		# the logfile is written anew for every session, and so is the
+		# store, the first time that it is opened
+		if path not in self.experiment.aoicolumnstores:
+			self.experiment.aoicolumnstores[path] = \
+				libaoi.columnstore(path, new=True)
+		
+		return self.experiment.aoicolumnstores[path]
+	
+	def store_metrics(self, firstenter):
+		
+		"""
+		Appends the trial's metrics to the column stores, with a row per AOI
+		(and a last row for fixations outside the AOIs) in the first, a
+		row per non-zero transition count in the second, and the raw gaze
+		samples (if any) in the third; only the trial's key is logged; in
+		gaze samples mode, which detects no fixations, the fixation
+		metrics are NaN and there are no transitions
+		
+		Arguments:
+		firstenter	--	a dict of the times at which gaze first entered
+					the AOIs, keyed by AOI name
+		"""
+		
+		key = self.experiment.get(u'count_%s' % self.name)
+		names = list(self._namelist) + [u'notAOI']
+		nan = numpy.nan
+		if self.crossings != None:
+			none = [nan] * len(names)
+			metrics = dict((name, none) for name in [u'fixcount', u'dwell', \
+				u'revisits', u'firstfix', u'firstfixdur'])
+		else:
+			metrics = {
+				u'fixcount': list(self._aoicount) + [self._notaoicount],
+				u'dwell': list(self.metrics.dwell) + [nan],
+				u'revisits': list(self.metrics.revisits) + [nan],
+				u'firstfix': list(self.metrics.firstfix) + [nan],
+				u'firstfixdur': list(self.metrics.firstfixdur) + [nan],
+				}
+		metrics[u'aoi'] = names
+		metrics[u'firstenter'] = [firstenter.get(name, nan) for name in names]
+		self.store.append(key, metrics)
+		fromaoi, toaoi, counts = self.metrics.transition_counts()
+		self.transitionstore.append(key, {
+			u'from': numpy.array(names)[fromaoi],
+			u'to': numpy.array(names)[toaoi],
+			u'count': counts,
+			})
+		# the tracker's own fixation events come without samples
+		if self.samples is None:
+			samples = numpy.zeros((0,3))
+		else:
+			samples = self.samples
+		self.samplestore.append(key, {u't': samples[:,0], \
+			u'x': samples[:,1], u'y': samples[:,2]})
+		self.experiment.set(u'aoi_store_trial', key)
+	
+	def handle_event(self, event, t0):
+
+		"""
+		Handles a tracker event
+
+		Arguments:
+		event		--	a (timestamp, kind, value) tuple, from the
+					tracker, a fixationdetector, or a crossingdetector
+		t0		--	the onset time of the trial
+
+		Returns:
+		True if the event ends the trial, False otherwise
+		"""
+		
+		t, kind, value = event
+		if kind == u'fixation_start':
+			# check if fixpos is in an AOI
+			fx, fy = value
+			hits = self.index.hits(fx, fy)
+			self._aoicount[hits] += 1 # add one to the count of every fixated AOI
+			
+			# if no AOI is hit
+			if len(hits) == 0:
+				self._notaoicount += 1
+			self.add_heat(t)
+			self.metrics.fixation_start(t, hits)
+			self.fixpos = value
+		elif kind == u'fixation_end':
+			self.add_heat(t)
+			self.metrics.fixation_end(t)
+		else:
+			# AOI enters and exits
+			self.events.append(event)
+			if kind == u'enter' and value == self.stopname:
+				self.response = value
+				self.resptime = t-t0
+				return True
+		
+		return False
+		
+
+class gridscene(QtGui.QGraphicsScene):
+
+	"""A graphics scene that draws a grid over its items, by tiling a
+	(cached) pixmap of one grid cell, rather than with an item for every
+	grid line"""
+
+	def __init__(self, width, height, color, opacity=0.25):
+
+		"""
+		Constructor
+
+		Arguments:
+		width		--	the width of the gridded area
+		height		--	the height of the gridded area
+		color		--	a QColor for the grid lines
+
+		Keyword arguments:
+		opacity	--	the opacity of the grid lines (default=0.25)
+		"""
+
+		QtGui.QGraphicsScene.__init__(self)
+		self.area = QtCore.QRectF(0, 0, width, height)
+		self.color = color
+		self.opacity = opacity
+		self.tile = None
+
+	def set_gridsize(self, gridsize):
+
+		"""
+		Sets the distance between grid lines
+
+		Arguments:
+		gridsize	--	the distance between grid lines in pixels
+		"""
+
+		key = gridsize, self.color.rgba(), self.opacity
+		if key not in _gridtiles:
+			tile = QtGui.QPixmap(gridsize, gridsize)
+			tile.fill(QtCore.Qt.transparent)
+			painter = QtGui.QPainter(tile)
+			painter.setOpacity(self.opacity)
+			painter.setPen(self.color)
+			# the lines run through the second row and column of pixels,
+			# like the grid lines that were drawn as items
+			painter.drawLine(1, 0, 1, gridsize)
+			painter.drawLine(0, 1, gridsize, 1)
+			painter.end()
+			_gridtiles[key] = tile
+		self.tile = _gridtiles[key]
+		self.update()
+
+	def drawForeground(self, painter, rect):
+
+		"""Draws the grid; overrides QGraphicsScene.drawForeground()"""
+
+		if self.tile == None:
+			return
+		# the brush is tiled from the scene origin
+		painter.fillRect(rect.intersected(self.area), QtGui.QBrush(self.tile))
+
 
 class qtaoi(aoi, qtplugin.qtplugin):
 
@@ -240,6 +750,9 @@ class qtaoi(aoi, qtplugin.qtplugin):
 			"The amount of time the sketchpad is shown, registering AOI fixations")
 		self.add_line_edit_control("aoiname", "AOI name", tooltip= \
 			"The name of the new AOI", default="aoi_%d" % self.aoinr)
+		self.add_combobox_control("aoishape", "AOI shape", \
+			['rectangle', 'ellipse'], \
+			tooltip = "The shape of the new AOI; an ellipse fills the rectangle defined below (polygons can be added to the script as ['polygon', [(x1,y1), (x2,y2), ...]])")
 		self.add_spinbox_control("x", "X position", 0, 10000, suffix=' px', \
 			tooltip= "The horizontal coordinate of the AOI")
 		self.add_spinbox_control("y", "Y position", 0, 10000, suffix=' px', \
@@ -282,6 +795,69 @@ class qtaoi(aoi, qtplugin.qtplugin):
 		# libqtopensesame.items.qtplugin.qtplugin
 		self.add_control("", widget, "click button to delete all AOI") # label, widget, tooltip: label is empty, since text is on button
 		
+		# AOI templates
+		self.add_line_edit_control("templatename", "Template name", tooltip= \
+			"Make this item's AOIs available as a template with this name, or nothing")
+		self.add_line_edit_control("usetemplate", "Use template", tooltip= \
+			"The name of a template whose AOIs are used instead of this item's own AOIs, or nothing")
+		self.add_line_edit_control("templatex", "Template x offset", tooltip= \
+			"The horizontal shift of the template's AOIs, in pixels; e.g. [center_x]")
+		self.add_line_edit_control("templatey", "Template y offset", tooltip= \
+			"The vertical shift of the template's AOIs, in pixels; e.g. [center_y]")
+		self.add_line_edit_control("templatescale", "Template scale", tooltip= \
+			"The scale factor of the template's AOIs, around the display centre")
+		
+		# hit testing
+		self.add_combobox_control("aoiindex", "AOI index", \
+			['none', 'grid', 'raster'], \
+			tooltip = "Test every AOI against every fixation, only the AOIs near a fixation (grid), or look fixations up in a precomputed raster of AOI labels (raster)")
+		self.add_spinbox_control('rasterscale', \
+			'Raster cell size', 1, 100, suffix=' px', tooltip= \
+			'The size of a cell in the AOI raster; 1 px is exact, larger cells use less memory, but are only accurate to a cell')
+		
+		# sample-rate AOI events
+		self.add_combobox_control("aoievents", "AOI events", \
+			['fixations', 'gaze samples'], \
+			tooltip = "Count the fixations in every AOI, or detect when every new gaze sample enters or exits an AOI (which only logs the first enter time of every AOI, and no fixation metrics)")
+		self.add_spinbox_control('aoimargin', \
+			'Exit margin', 0, 500, suffix=' px', tooltip= \
+			'Gaze only exits an AOI once it is further than this away from it (gaze samples only)')
+		self.add_spinbox_control('aoidelay', \
+			'Enter/exit delay', 0, 1000, suffix=' ms', tooltip= \
+			'Gaze only enters or exits an AOI once it has been in or out of it for this long (gaze samples only)')
+		self.add_line_edit_control("stopaoi", "End trial on AOI", tooltip= \
+			"The name of an AOI that ends the trial as soon as gaze enters it, or nothing (gaze samples only)")
+		
+		# fixation detection
+		self.add_combobox_control("fixdetect", "Fixation detection", \
+			['tracker', 'I-VT', 'I-DT'], \
+			tooltip = "Use the eye tracker's fixation events (which are waited for, so that the timeout and key presses are only checked between fixation starts and ends), or detect fixations in the raw gaze samples with a velocity (I-VT) or dispersion (I-DT) threshold")
+		self.add_spinbox_control('fixvelocity', \
+			'Velocity threshold', 1, 100000, suffix=' px/s', tooltip= \
+			'Gaze that moves slower than this is fixating (I-VT only)')
+		self.add_spinbox_control('fixdispersion', \
+			'Dispersion threshold', 1, 1000, suffix=' px', tooltip= \
+			'Gaze that stays within this horizontal plus vertical range is fixating (I-DT only)')
+		self.add_spinbox_control('fixmindur', \
+			'Minimal fixation duration', 0, 1000, suffix=' ms', tooltip= \
+			'The minimal duration of a fixation, which is also the delay with which fixations are detected (I-VT and I-DT only)')
+		
+		# heatmaps
+		self.add_combobox_control("heatmap", "Save heatmap", \
+			['no', 'yes'], \
+			tooltip = "Accumulate fixations, weighted by their duration, into a heatmap of the sketchpad, which is saved next to the logfile (summed over all trials with the sketchpad)")
+		self.add_spinbox_control('heatmapcell', \
+			'Heatmap cell size', 1, 100, suffix=' px', tooltip= \
+			'The width and height of a heatmap cell')
+		self.add_spinbox_control('heatmapsigma', \
+			'Heatmap smoothing', 0, 500, suffix=' px', tooltip= \
+			'The standard deviation of the Gaussian kernel that the heatmap is smoothed with')
+		
+		# output
+		self.add_combobox_control("outputmode", "Output", \
+			['variables', 'column store'], \
+			tooltip = "Log the metrics of every AOI as variables, or append them to column stores next to the logfile and only log the trial's key (aoi_store_trial)")
+		
 		# grid size editor
 		self.add_spinbox_control('gridsize', \
 			'Grid size', 5, 1000, suffix=' px', tooltip= \
@@ -291,24 +867,27 @@ class qtaoi(aoi, qtplugin.qtplugin):
 		self.add_text("<br><br><small><b>Copyrights Edwin S. Dalmaijer, 2013. Based on PyGaze toolbox: http://www.fss.uu.nl/psn/pygaze/</b></small>")
 
 		# image showing AOIs (should we present canvas on this?)
-		self.scene = QtGui.QGraphicsScene() # QGraphicsScene
+		self.bgw, self.bgh = self.experiment.resolution()
+		self.scene = gridscene(self.bgw, self.bgh, QtGui.QColor(0,255,0)) # QGraphicsScene
 		self.view = QtGui.QGraphicsView() # QGraphicsView to show scene
 		self.view.setRenderHint(QtGui.QPainter.Antialiasing)
 		self.view.setScene(self.scene)
 		self.view.setFocusPolicy(QtCore.Qt.NoFocus)
+		# the scene is updated incrementally: the sketchpad is only drawn
+		# again when it changes, and only the AOIs that changed are drawn
+		# again
+		self.sketchpadkey = None
+		self.sketchpaditems = None
+		self.aoiitems = {}
+		self.warnings = []
 
 		# AOI image background
-		self.bgw, self.bgh = self.experiment.resolution()
 		self.bgpen = QtGui.QPen()
 		self.bgbrush = QtGui.QBrush()
 		self.bgpen.setColor(QtGui.QColor(0))
 		self.bgbrush.setColor(QtGui.QColor(0))
 		self.bgbrush.setStyle(QtCore.Qt.SolidPattern)
 		self.scene.setBackgroundBrush(self.bgbrush)
-		# draw sketchpad
-		if hasattr(self, u'spname'):
-			if self.spname in self.experiment.items:
-				self.add_sketchpad(self.experiment.items[self.spname])
 		
 		# AOI image properties
 		self.font = QtGui.QFont("sans", 12, QtGui.QFont.Normal, False) # fontfamily, str; pointsize, int; weight, QFont.Normal/Bold; italic, bool
@@ -316,9 +895,6 @@ class qtaoi(aoi, qtplugin.qtplugin):
 		self.pen = QtGui.QPen()
 		self.pen.setWidth(3)
 		self.pen.setColor(QtGui.QColor(self.aoicol,self.aoicol,self.aoicol))
-		self.gridpen = QtGui.QPen()
-		self.gridpen.setWidth(1)
-		self.gridpen.setColor(QtGui.QColor(0,255,0))
 		self.add_grid(gridsize=self.get(u'gridsize'))
 		self.brush = QtGui.QBrush()
 		self.brush.setColor(QtGui.QColor(self.aoicol,self.aoicol,self.aoicol))
@@ -340,9 +916,13 @@ class qtaoi(aoi, qtplugin.qtplugin):
 	def add_aoi(self):
 
 		# bookkeeping		
-		self.aoidict[self.aoiname] = [self.x, self.y, self.w, self.h]
+		self.aoidict = libaoi.parse_aoidict(str(self.get(u'aoidictstr')))
+		if self.get(u'aoishape') == u'ellipse':
+			self.aoidict[self.aoiname] = ['ellipse', self.x, self.y, self.w, self.h]
+		else:
+			self.aoidict[self.aoiname] = [self.x, self.y, self.w, self.h]
 		self.set("aoinr", len(self.aoidict))
-		self.set("aoidictstr", self.aoidict)
+		self.set("aoidictstr", str(self.aoidict))
 		#self.experiment.aoidict = self.aoidict
 		
 		# gui
@@ -354,7 +934,7 @@ class qtaoi(aoi, qtplugin.qtplugin):
 		# bookkeeping
 		self.aoidict = {}
 		self.set("aoinr", len(self.aoidict))
-		self.set("aoidictstr", self.aoidict)
+		self.set("aoidictstr", str(self.aoidict))
 
 		# gui
 		self.update_color(clearall=True)
@@ -381,27 +961,81 @@ class qtaoi(aoi, qtplugin.qtplugin):
 		
 		"""Refresh the AOI preview display"""
 		
-		# clear scene
-		self.scene.clear()
-		# draw sketchpad
-		if hasattr(self, u'spname'):
-			if self.spname in self.experiment.items:
+		for warning in self.warnings:
+			self.scene.removeItem(warning)
+		self.warnings = []
+		# draw sketchpad, as one group of items that is only drawn again
+		# when the sketchpad changes
+		if hasattr(self, u'spname') and self.spname in self.experiment.items:
+			key = self.spname, self.experiment.items[self.spname].to_string()
+		else:
+			key = None
+		if key != self.sketchpadkey:
+			if self.sketchpaditems != None:
+				self.scene.removeItem(self.sketchpaditems)
+				self.sketchpaditems = None
+			if key != None:
+				before = set(self.scene.items())
 				self.add_sketchpad(self.experiment.items[self.spname])
-			else:
-				warning = self.scene.addText(u"sketchpad '%s' not found" % self.spname, self.font)
-				warning.setDefaultTextColor(QtGui.QColor(255,0,0))
-		# draw AOIs
-		exec("self.aoidict = %s" % self.get(u'aoidictstr'))
-		for aoiname in self.aoidict.keys():
-			x, y, w, h = self.aoidict[aoiname]
+				self.sketchpaditems = self.scene.createItemGroup( \
+					[i for i in self.scene.items() if i not in before])
+				self.sketchpaditems.setZValue(-1)
+			self.sketchpadkey = key
+		if key == None and hasattr(self, u'spname'):
+			warning = self.scene.addText(u"sketchpad '%s' not found" % self.spname, self.font)
+			warning.setDefaultTextColor(QtGui.QColor(255,0,0))
+			self.warnings.append(warning)
+		# draw AOIs, from the same compiled AOI set as prepare() uses
+		if not hasattr(self.experiment, u'aoisets'):
+			self.experiment.aoisets = collections.OrderedDict()
+		try:
+			aois = libaoi.compile_aoiset(self.get(u'aoidictstr'), \
+				cache=self.experiment.aoisets)
+		except ValueError as e:
+			warning = self.scene.addText(u"invalid AOIs: %s" % e, self.font)
+			warning.setDefaultTextColor(QtGui.QColor(255,0,0))
+			self.warnings.append(warning)
+			aois = libaoi.aoiset({})
+		for i in range(len(aois)):
+			aoiname = aois.names[i]
+			x, y = aois.lx[i], aois.ty[i]
+			w, h = aois.rx[i] - x, aois.by[i] - y
+			# AOIs that did not change are left alone
+			key = aois.shape[i], x, y, w, h, \
+				tuple(map(tuple, aois.vertices(i).tolist()))
+			if aoiname in self.aoiitems:
+				if self.aoiitems[aoiname][0] == key:
+					continue
+				self.remove_aoi_items(aoiname)
 			self.update_color()
-			self.scene.addRect(x,y,w,h,self.pen,self.brush)
+			if aois.shape[i] == libaoi.POLYGON:
+				polygon = QtGui.QPolygonF([QtCore.QPointF(vx, vy) for vx, vy \
+					in aois.vertices(i)])
+				aoiitem = self.scene.addPolygon(polygon,self.pen,self.brush)
+			elif aois.shape[i] == libaoi.ELLIPSE:
+				aoiitem = self.scene.addEllipse(x,y,w,h,self.pen,self.brush)
+			else:
+				aoiitem = self.scene.addRect(x,y,w,h,self.pen,self.brush)
 			aoilbl = self.scene.addText(aoiname,self.font)
 			aoilbl.setDefaultTextColor(QtGui.QColor(0))
 			lblrect = aoilbl.boundingRect()
 			aoilbl.setPos((x+w/2)-(lblrect.width()/2), (y+h/2)-(lblrect.height()/2))
+			aoilbl.setZValue(1)
+			self.aoiitems[aoiname] = key, aoiitem, aoilbl
+		# remove AOIs that no longer exist
+		for aoiname in list(self.aoiitems.keys()):
+			if aoiname not in aois.names:
+				self.remove_aoi_items(aoiname)
 		# draw grid
 		self.add_grid(gridsize=self.get(u'gridsize'))
+	
+	def remove_aoi_items(self, aoiname):
+		
+		"""Remove an AOI from the AOI preview display"""
+		
+		key, aoiitem, aoilbl = self.aoiitems.pop(aoiname)
+		self.scene.removeItem(aoiitem)
+		self.scene.removeItem(aoilbl)
 
 	def apply_edit_changes(self):
 
@@ -428,15 +1062,7 @@ class qtaoi(aoi, qtplugin.qtplugin):
 		
 		"""Draw a grid over the entire scene"""
 		
-		# vertical lines
-		for l in range(1,self.bgw-1,gridsize):
-			line = self.scene.addLine(l, 1, l, self.bgh, self.gridpen)
-			line.setOpacity(0.25)
-		
-		# horizontal lines
-		for l in range(1,self.bgh,gridsize):
-			line = self.scene.addLine(1, l, self.bgw, l, self.gridpen)
-			line.setOpacity(0.25)
+		self.scene.set_gridsize(gridsize)
 	
 	# all of the functions below are directly ripped off from the sketchpad widget
 	# https://github.com/smathot/OpenSesame/blob/master/libqtopensesame/widgets/sketchpad_widget.py
@@ -573,6 +1199,16 @@ class qtaoi(aoi, qtplugin.qtplugin):
 	
 		"""Draw image"""
 		
+		# the file is only read again when it has changed
+		try:
+			mtime = os.path.getmtime(path)
+		except OSError:
+			mtime = None
+		key = u'image', path, mtime, scale
+		pixmap = _pixmapcache.get(key, None)
+		if pixmap is not None:
+			return self.add_pixmap(pixmap, center, x, y)
+		
 		pixmap = QtGui.QPixmap(path)
 		
 		if pixmap.isNull():
@@ -589,6 +1225,13 @@ class qtaoi(aoi, qtplugin.qtplugin):
 		
 		w = pixmap.width()*scale
 		pixmap = pixmap.scaledToWidth(w)
+		_pixmapcache.put(key, None, pixmap, 4*pixmap.width()*pixmap.height())
+		return self.add_pixmap(pixmap, center, x, y)
+	
+	def add_pixmap(self, pixmap, center, x, y):
+	
+		"""Draw pixmap"""
+		
 		_item = self.scene.addPixmap(pixmap)
 		if center:
 			_item.setPos(x - 0.5 * pixmap.width(), y - 0.5 * pixmap.height())
@@ -600,23 +1243,27 @@ class qtaoi(aoi, qtplugin.qtplugin):
 	
 		"""Draw gabor patch"""
 		
-		path = openexp.canvas.gabor_file(item["orient"], item["freq"], \
-		item["env"], item["size"], item["stdev"], item["phase"], \
-		item["color1"], item["color2"], item["bgmode"])
-		pixmap = QtGui.QPixmap(path)
-		_item = self.scene.addPixmap(pixmap)
-		_item.setPos(item["x"]-0.5*pixmap.width(), \
-		item["y"]-0.5*pixmap.height())
-		return _item
+		params = item["orient"], item["freq"], item["env"], item["size"], \
+		item["stdev"], item["phase"], item["color1"], item["color2"], \
+		item["bgmode"]
+		pixmap = _pixmapcache.get((u'gabor',) + params, None)
+		if pixmap is None:
+			path = openexp.canvas.gabor_file(*params)
+			pixmap = QtGui.QPixmap(path)
+			_pixmapcache.put((u'gabor',) + params, None, pixmap, \
+			4*pixmap.width()*pixmap.height())
+		return self.add_pixmap(pixmap, True, item["x"], item["y"])
 	
 	def noise(self, item):
 	
 		"""Draw noise patch"""
 		
-		path = openexp.canvas.noise_file(item["env"], item["size"], \
-		item["stdev"], item["color1"], item["color2"], item["bgmode"])
-		pixmap = QtGui.QPixmap(path)
-		_item = self.scene.addPixmap(pixmap)
-		_item.setPos(item["x"]-0.5*pixmap.width(), \
-		item["y"]-0.5*pixmap.height())
-		return _item
\ No newline at end of file
+		params = item["env"], item["size"], item["stdev"], item["color1"], \
+		item["color2"], item["bgmode"]
+		pixmap = _pixmapcache.get((u'noise',) + params, None)
+		if pixmap is None:
+			path = openexp.canvas.noise_file(*params)
+			pixmap = QtGui.QPixmap(path)
+			_pixmapcache.put((u'noise',) + params, None, pixmap, \
+			4*pixmap.width()*pixmap.height())
+		return self.add_pixmap(pixmap, True, item["x"], item["y"])
\ No newline at end of file
@@ -0,0 +1,442 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Applies the AOIs of an experiment's aoi items to recorded gaze data,
+# after the experiment has been run. The AOI definitions are read from the
+# experiment's script, and every log (one per participant) is streamed in
+# chunks and classified by its own worker process, so that memory use does
+# not grow with the size of the logs. The results, with one row for every
+# participant, aoi item, trial, and AOI (including notAOI), are written as
+# columns to a NumPy .npz file, e.g.:
+#
+#	python aoi/aoianalysis.py experiment.opensesame logs/*.asc \
+#		--output results.npz
+
+import os
+import re
+import sys
+import csv
+import shlex
+import tarfile
+import argparse
+import multiprocessing
+import numpy
+
+_plugindir = os.path.dirname(os.path.abspath(__file__))
+if _plugindir not in sys.path:
+	sys.path.append(_plugindir)
+import libaoi
+
+# the output columns
+COLUMNS = [u'participant', u'item', u'trial', u'aoi', u'fixations', u'dwell']
+
+
+def read_aoisets(path):
+
+	"""Returns the AOI sets of all aoi items in an experiment script; the
+	AOIs of items that use a template are those of the template, placed
+	with the item's offset and scale, which can only be done offline when
+	these are numbers rather than (per-trial) variables
+
+	arguments
+	path		--	the path of an .opensesame script, or of an
+				.opensesame.tar.gz file that contains one
+
+	returns
+	aoisets	--	a dict of item names and aoisets, or None for items
+				whose template placement depends on variables
+	"""
+
+	if path.endswith(u'.tar.gz'):
+		archive = tarfile.open(path)
+		lines = archive.extractfile(u'script.opensesame').read().decode( \
+			u'utf-8').splitlines()
+		archive.close()
+	else:
+		f = open(path)
+		lines = f.read().splitlines()
+		f.close()
+
+	# the settings of every aoi item, and the experiment's resolution,
+	# with OpenSesame's defaults
+	settings = {}
+	resolution = {u'width': 1024, u'height': 768}
+	item = None
+	define = False
+	for line in lines:
+		try:
+			words = shlex.split(line)
+		except ValueError:
+			continue
+		if len(words) == 0:
+			continue
+		if words[0] == u'define':
+			define = True
+			if len(words) == 3 and words[1] == u'aoi':
+				item = words[2]
+				settings[item] = {u'aoidictstr': u'{}', u'templatename': u'', \
+					u'usetemplate': u'', u'templatex': u'0', \
+					u'templatey': u'0', u'templatescale': u'1'}
+			else:
+				item = None
+		elif len(words) == 3 and words[0] == u'set':
+			if item != None and words[1] in settings[item]:
+				settings[item][words[1]] = words[2]
+			elif not define and words[1] in resolution:
+				resolution[words[1]] = float(words[2])
+
+	templates = dict((setting[u'templatename'], setting[u'aoidictstr']) \
+		for setting in settings.values() if setting[u'templatename'] != u'')
+	origin = resolution[u'width'] / 2.0, resolution[u'height'] / 2.0
+	aoisets = {}
+	for item, setting in settings.items():
+		if setting[u'usetemplate'] == u'':
+			aoisets[item] = libaoi.compile_aoiset(setting[u'aoidictstr'])
+			continue
+		if setting[u'usetemplate'] not in templates:
+			raise ValueError(u"aoi item '%s' uses an unknown AOI template '%s'" \
+				% (item, setting[u'usetemplate']))
+		try:
+			placement = [float(setting[key]) for key in [u'templatex', \
+				u'templatey', u'templatescale']]
+		except ValueError:
+			aoisets[item] = None
+			continue
+		aoisets[item] = libaoi.compile_aoiset(templates[ \
+			setting[u'usetemplate']]).transformed(*placement, origin=origin)
+
+	return aoisets
+
+
+def read_csv(path, options):
+
+	"""Reads a CSV log with a header in chunks
+
+	arguments
+	path		--	the path of the log
+	options	--	a dict with the names of the 'trialcol', 'timecol',
+				'xcol', 'ycol', and 'durcol' columns (the trial, time,
+				and duration columns are optional), the 'samples' flag
+				and the sampling 'rate', and the 'chunksize'
+
+	yields
+	trials, times, positions, durations	--	a chunk of the log, as an
+				array of trial IDs, an array of timestamps, an n x 2
+				array of (x,y) positions, and an array of durations
+	"""
+
+	f = open(path)
+	reader = csv.reader(f)
+	header = next(reader)
+	for col in [options[u'xcol'], options[u'ycol']]:
+		if col not in header:
+			raise ValueError(u"%s has no column '%s'" % (path, col))
+	ix = header.index(options[u'xcol'])
+	iy = header.index(options[u'ycol'])
+	it = header.index(options[u'trialcol']) if options[u'trialcol'] in \
+		header else None
+	itime = header.index(options[u'timecol']) if options[u'timecol'] in \
+		header else None
+	idur = header.index(options[u'durcol']) if options[u'durcol'] in \
+		header and not options[u'samples'] else None
+
+	rows = []
+	for row in reader:
+		if len(row) == 0:
+			continue
+		if it == None:
+			trial = u''
+		else:
+			trial = row[it]
+		if idur == None:
+			duration = 1000.0 / options[u'rate'] if options[u'samples'] \
+				else 0
+		else:
+			duration = _number(row[idur])
+		if itime == None:
+			t = numpy.nan
+		else:
+			t = _number(row[itime])
+		rows.append((trial, t, _number(row[ix]), _number(row[iy]), \
+			duration))
+		if len(rows) == options[u'chunksize']:
+			yield _chunk(rows)
+			rows = []
+	f.close()
+	if len(rows) > 0:
+		yield _chunk(rows)
+
+
+def read_asc(path, options):
+
+	"""Reads an EyeLink ASC log in chunks; fixations are read from the
+	EFIX events, and samples from the sample lines, while trials start at
+	the messages that match the 'trialmsg' regular expression (the last word
+	of the message is the trial ID)
+
+	arguments
+	path		--	the path of the log
+	options	--	a dict with the 'samples' flag, the sampling 'rate',
+				the 'trialmsg', and the 'chunksize'
+
+	yields
+	trials, times, positions, durations	--	a chunk of the log, as
+				returned by read_csv
+	"""
+
+	trialmsg = re.compile(options[u'trialmsg'])
+	samples = options[u'samples']
+	interval = 1000.0 / options[u'rate']
+	trial = u''
+	rows = []
+	f = open(path)
+	for line in f:
+		words = line.split()
+		if len(words) == 0:
+			continue
+		if words[0] == u'MSG':
+			if trialmsg.search(line):
+				trial = words[-1]
+			continue
+		if samples:
+			# sample lines start with the timestamp
+			if not words[0].isdigit() or len(words) < 3:
+				continue
+			rows.append((trial, _number(words[0]), _number(words[1]), \
+				_number(words[2]), interval))
+		else:
+			# EFIX <eye> <start> <end> <duration> <x> <y> ...
+			if words[0] != u'EFIX' or len(words) < 7:
+				continue
+			rows.append((trial, _number(words[2]), _number(words[5]), \
+				_number(words[6]), _number(words[4])))
+		if len(rows) == options[u'chunksize']:
+			yield _chunk(rows)
+			rows = []
+	f.close()
+	if len(rows) > 0:
+		yield _chunk(rows)
+
+
+def analyse(task):
+
+	"""Classifies all fixations (or samples) of a log; runs in a worker
+	process
+
+	arguments
+	task		--	a (path, aoisets, options) tuple
+
+	returns
+	columns	--	a dict of output columns (see COLUMNS)
+	"""
+
+	path, aoisets, options = task
+	if path.lower().endswith(u'.asc'):
+		chunks = read_asc(path, options)
+	else:
+		chunks = read_csv(path, options)
+	if options[u'detect'] != None:
+		chunks = detect(chunks, options)
+
+	# per-trial totals, by item and trial; the last count and dwell time
+	# are those of notAOI
+	totals = {}
+	trialorder = []
+	seen = set()
+	for trials, times, positions, durations in chunks:
+		# runs of rows of the same trial
+		bounds = numpy.flatnonzero(trials[1:] != trials[:-1]) + 1
+		starts = numpy.concatenate(([0], bounds))
+		ends = numpy.concatenate((bounds, [len(trials)]))
+		for start, end in zip(starts, ends):
+			trial = trials[start]
+			if trial not in seen:
+				seen.add(trial)
+				trialorder.append(trial)
+			for item, aois in aoisets.items():
+				counts, dwell, labels = libaoi.classify(aois, \
+					positions[start:end], durations[start:end])
+				outside = labels == -1
+				key = item, trial
+				if key not in totals:
+					totals[key] = numpy.zeros(len(aois)+1, dtype=int), \
+						numpy.zeros(len(aois)+1)
+				totals[key][0][:-1] += counts
+				totals[key][0][-1] += outside.sum()
+				totals[key][1][:-1] += dwell
+				totals[key][1][-1] += durations[start:end][outside].sum()
+
+	columns = dict((col, []) for col in COLUMNS)
+	participant = os.path.splitext(os.path.basename(path))[0]
+	for item in sorted(aoisets.keys()):
+		names = list(aoisets[item].names) + [u'notAOI']
+		for trial in trialorder:
+			if (item, trial) not in totals:
+				continue
+			counts, dwell = totals[(item, trial)]
+			for i in range(len(names)):
+				columns[u'participant'].append(participant)
+				columns[u'item'].append(item)
+				columns[u'trial'].append(trial)
+				columns[u'aoi'].append(names[i])
+				columns[u'fixations'].append(counts[i])
+				columns[u'dwell'].append(dwell[i])
+
+	return columns
+
+
+def detect(chunks, options):
+
+	"""Turns chunks of gaze samples into chunks of fixations, with a
+	fixation detector that starts anew for every trial
+
+	arguments
+	chunks		--	an iterable of sample chunks, as yielded by read_csv
+				and read_asc
+	options	--	a dict with the 'detect' method, the 'threshold',
+				and the minimal duration ('mindur')
+
+	yields
+	trials, times, positions, durations	--	a chunk of fixations,
+				with their onsets as times
+	"""
+
+	detector = libaoi.fixationdetector(options[u'detect'], \
+		threshold=options[u'threshold'], mindur=options[u'mindur'])
+	trial = None
+	events = []
+	for trials, times, positions, durations in chunks:
+		rows = []
+		bounds = numpy.flatnonzero(trials[1:] != trials[:-1]) + 1
+		starts = numpy.concatenate(([0], bounds))
+		ends = numpy.concatenate((bounds, [len(trials)]))
+		for start, end in zip(starts, ends):
+			if trials[start] != trial:
+				events.extend(detector.flush())
+				rows.extend(_fixationrows(trial, events))
+				events = []
+				trial = trials[start]
+			events.extend(detector.update(numpy.column_stack( \
+				(times[start:end], positions[start:end]))))
+		# a fixation that has started, but not ended, is kept for the next
+		# chunk
+		rows.extend(_fixationrows(trial, events))
+		if len(events) > 0 and events[-1][1] == u'fixation_start':
+			events = events[-1:]
+		else:
+			events = []
+		if len(rows) > 0:
+			yield _chunk(rows)
+	rows = _fixationrows(trial, events + detector.flush())
+	if len(rows) > 0:
+		yield _chunk(rows)
+
+
+def _fixationrows(trial, events):
+
+	"""Converts fixation events to (trial, onset, x, y, duration) rows; for
+	internal use"""
+
+	return [(trial, onset, x, y, duration) for onset, end, duration, x, y \
+		in libaoi.fixation_table(events)]
+
+
+def _number(value):
+
+	"""Converts a log value to a float, with NaN for missing values; for
+	internal use"""
+
+	try:
+		return float(value)
+	except ValueError:
+		return numpy.nan
+
+
+def _chunk(rows):
+
+	"""Converts a list of (trial, time, x, y, duration) rows to arrays; for
+	internal use"""
+
+	trials, times, xs, ys, durations = zip(*rows)
+
+	return numpy.array(trials), numpy.array(times, dtype=float), \
+		numpy.column_stack((xs, ys)), numpy.array(durations, dtype=float)
+
+
+def main():
+
+	parser = argparse.ArgumentParser(description=u"Applies the AOIs of an experiment's aoi items to recorded gaze logs")
+	parser.add_argument('experiment', help=u'the experiment (.opensesame or .opensesame.tar.gz)')
+	parser.add_argument('logs', nargs='+', help=u'gaze logs, one per participant: EyeLink .asc files, or CSV files with a header')
+	parser.add_argument('--output', default='aoi_results.npz', help=u'the output file (default: aoi_results.npz)')
+	parser.add_argument('--item', nargs='+', help=u'the aoi items to apply (default: all)')
+	parser.add_argument('--samples', action='store_true', help=u'the logs contain gaze samples, rather than fixations')
+	parser.add_argument('--detect', choices=[u'ivt', u'idt'], help=u'detect fixations in the gaze samples (with --samples) with a velocity (ivt) or dispersion (idt) threshold, rather than classifying every sample')
+	parser.add_argument('--threshold', type=float, help=u'the velocity threshold in px/s, or the dispersion threshold in px (default: 1000 px/s or 50 px)')
+	parser.add_argument('--mindur', type=float, default=100, help=u'the minimal fixation duration in ms (default: 100)')
+	parser.add_argument('--rate', type=float, default=1000, help=u'the sampling rate in Hz, which sets the duration of a sample (default: 1000)')
+	parser.add_argument('--trialmsg', default=u'TRIALID|start_trial', help=u'a regular expression for the ASC messages that start a trial (default: TRIALID|start_trial)')
+	parser.add_argument('--trialcol', default=u'trial', help=u'the CSV column with trial IDs (default: trial)')
+	parser.add_argument('--timecol', default=u'time', help=u'the CSV column with timestamps in ms, which is needed by --detect (default: time)')
+	parser.add_argument('--xcol', default=u'x', help=u'the CSV column with x coordinates (default: x)')
+	parser.add_argument('--ycol', default=u'y', help=u'the CSV column with y coordinates (default: y)')
+	parser.add_argument('--durcol', default=u'duration', help=u'the CSV column with fixation durations (default: duration)')
+	parser.add_argument('--chunksize', type=int, default=100000, help=u'the number of rows that is read at once (default: 100000)')
+	parser.add_argument('--jobs', type=int, default=None, help=u'the number of worker processes (default: one per core)')
+	args = parser.parse_args()
+
+	try:
+		aoisets = read_aoisets(args.experiment)
+	except ValueError as e:
+		parser.error(e)
+	if args.item != None:
+		for item in args.item:
+			if item not in aoisets:
+				parser.error(u"there is no aoi item '%s'" % item)
+			if aoisets[item] is None:
+				parser.error(u"aoi item '%s' places its AOI template with variables, which are not in the logs" % item)
+		aoisets = dict((item, aoisets[item]) for item in args.item)
+	# items that place a template with (per-trial) variables cannot be
+	# analysed offline
+	for item in sorted(aoisets.keys()):
+		if aoisets[item] is None:
+			sys.stderr.write(u"skipping aoi item '%s', which places its AOI template with variables\n" % item)
+			del aoisets[item]
+	if len(aoisets) == 0:
+		parser.error(u'the experiment has no aoi items')
+	if args.detect != None and not args.samples:
+		parser.error(u'--detect needs gaze samples (--samples)')
+	options = dict((key, getattr(args, key)) for key in [u'samples', \
+		u'rate', u'detect', u'threshold', u'mindur', u'trialmsg', \
+		u'trialcol', u'timecol', u'xcol', u'ycol', u'durcol', u'chunksize'])
+
+	# one task per log, in the order of the logs
+	pool = multiprocessing.Pool(args.jobs)
+	columns = dict((col, []) for col in COLUMNS)
+	for result in pool.imap(analyse, [(path, aoisets, options) for path in \
+		args.logs]):
+		for col in COLUMNS:
+			columns[col].extend(result[col])
+	pool.close()
+	pool.join()
+
+	numpy.savez_compressed(args.output, **dict((str(col), \
+		numpy.array(values)) for col, values in columns.items()))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,1936 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import io
+import ast
+import time
+import hashlib
+import collections
+import threading
+import numpy
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+# Note that the AOI and FRL plug-ins are installed separately, so that both
+# carry their own copy of the gaze sampler, the canvas cache, and the column
+# store; the plug-ins keep their instances under their own experiment
+# attributes (e.g. experiment.aoicanvascache and experiment.frlcanvascache),
+# so that one plug-in never uses the other's copy.
+
+# label rasters are shared by all AOI items with the same layout; only the
+# most recently used ones are kept
+_rastercache = collections.OrderedDict()
+RASTERCACHESIZE = 8
+
+# Gaussian smoothing kernels for heatmaps, by size and width
+_smoothers = {}
+
+# compiled AOI sets are cached by their definition string, e.g. for all
+# trials of an experiment; only the most recently used ones are kept
+AOISETCACHESIZE = 16
+
+
+# AOI shapes
+RECT = 0
+ELLIPSE = 1
+POLYGON = 2
+SHAPES = {u'rect': RECT, u'rectangle': RECT, u'ellipse': ELLIPSE, \
+	u'polygon': POLYGON}
+
+
+def hittest(lx, rx, ty, by, fx, fy):
+
+	"""Returns which AOIs contain a position
+
+	arguments
+	lx		--	array of left x borders
+	rx		--	array of right x borders
+	ty		--	array of top y borders
+	by		--	array of bottom y borders
+	fx		--	x coordinate
+	fy		--	y coordinate
+
+	returns
+	hits		--	a boolean array, which is True for every AOI that
+				contains the position
+	"""
+
+	xina = (lx < fx) == (rx > fx) # position between x borders
+	yina = (by < fy) == (ty > fy) # position between y borders
+
+	return xina & yina
+
+
+def parse_aoi(aoi):
+
+	"""Returns the shape and the parameters of an AOI definition
+
+	arguments
+	aoi		--	an AOI definition, as stored in an aoidict: a
+				[x, y, w, h] list for a rectangle, an
+				['ellipse', x, y, w, h] list for the ellipse that fits
+				within that rectangle, or a
+				['polygon', [(x1,y1), (x2,y2), ...]] list for a polygon
+
+	returns
+	shape, params	--	the shape (RECT, ELLIPSE, or POLYGON), and either
+				an (x, y, w, h) tuple, or a list of (x,y) vertices
+	"""
+
+	if len(aoi) == 4 and not isinstance(aoi[0], (str, type(u''))):
+		return RECT, tuple(aoi)
+	if len(aoi) == 0 or aoi[0] not in SHAPES:
+		raise ValueError(u"unknown AOI definition '%s'" % str(aoi))
+	shape = SHAPES[aoi[0]]
+	if shape == POLYGON:
+		if len(aoi) != 2 or len(aoi[1]) < 3:
+			raise ValueError(u"a polygon AOI needs at least three vertices")
+		return shape, [tuple(vertex) for vertex in aoi[1]]
+	if len(aoi) != 5:
+		raise ValueError(u"an %s AOI needs an x, y, w, and h" % aoi[0])
+
+	return shape, tuple(aoi[1:])
+
+
+def parse_aoidict(aoidictstr):
+
+	"""Parses an AOI definition string, as stored in an aoi item's script
+
+	arguments
+	aoidictstr	--	the string representation of a dict of AOI names and
+				definitions (see parse_aoi)
+
+	returns
+	aoidict		--	the dict
+	"""
+
+	try:
+		aoidict = ast.literal_eval(aoidictstr)
+	except (ValueError, SyntaxError):
+		raise ValueError(u"could not parse the AOI definitions '%s'" % \
+			aoidictstr)
+	if not isinstance(aoidict, dict):
+		raise ValueError(u"the AOI definitions '%s' are not a dict" % \
+			aoidictstr)
+
+	return aoidict
+
+
+def compile_aoiset(aoidictstr, cache=None):
+
+	"""Returns the aoiset of an AOI definition string, which is only parsed
+	and compiled when it is not in the cache yet
+
+	arguments
+	aoidictstr	--	an AOI definition string (see parse_aoidict)
+
+	keyword arguments
+	cache		--	an OrderedDict of definition strings and aoisets,
+				e.g. one that is shared by all items of an
+				experiment, or None (default = None)
+
+	returns
+	aois		--	an aoiset
+	"""
+
+	aoidictstr = str(aoidictstr)
+	if cache is None:
+		return aoiset(parse_aoidict(aoidictstr))
+	if aoidictstr in cache:
+		aois = cache.pop(aoidictstr)
+	else:
+		aois = aoiset(parse_aoidict(aoidictstr))
+	cache[aoidictstr] = aois
+	while len(cache) > AOISETCACHESIZE:
+		cache.popitem(last=False)
+
+	return aois
+
+
+class aoiset(object):
+
+	"""A set of AOIs, stored in a structured array, so that a position can
+	be tested against all of them at once; the borders of a rectangle are
+	tested exactly as before, and those of ellipses and polygons are
+	bounding boxes, which prefilter the (more costly) tests of their
+	shapes"""
+
+	# one record per AOI: its shape, its borders or bounding box, and the
+	# centre and radii of ellipses
+	DTYPE = numpy.dtype([('shape', numpy.int8), ('lx', float), \
+		('rx', float), ('ty', float), ('by', float), ('cx', float), \
+		('cy', float), ('ax', float), ('ay', float)])
+
+	def __init__(self, aoidict=None, names=None, table=None, edges=None, \
+		nedges=None):
+
+		"""
+		Constructor
+
+		Keyword arguments:
+		aoidict	--	a dict of AOI names and definitions (see parse_aoi);
+					the other keywords are only used to build a
+					transformed copy (default=None)
+		names		--	an array of AOI names (default=None)
+		table		--	a structured array with one DTYPE record per AOI
+					(default=None)
+		edges		--	an array of (x0, y0, x1, y1) polygon edges,
+					sorted by AOI (default=None)
+		nedges		--	an array with the number of edges of every AOI
+					(default=None)
+		"""
+
+		if aoidict is not None:
+			names, table, edges, nedges = self._compile(aoidict)
+		self.names = names
+		self.table = table
+		self.edges = edges
+		self.edgestart = numpy.concatenate(([0], numpy.cumsum(nedges)))
+		for field in self.DTYPE.names:
+			setattr(self, field, numpy.ascontiguousarray(table[field]))
+		self.rectsonly = bool((self.shape == RECT).all())
+		# hit-test engines that are built for this aoiset, which live as
+		# long as the aoiset itself
+		self.indexes = {}
+
+	def vertices(self, i):
+
+		"""
+		Returns the vertices of a polygon AOI
+
+		Arguments:
+		i		--	the index of the AOI
+
+		Returns:
+		An n x 2 array of (x,y) vertices
+		"""
+
+		return self.edges[self.edgestart[i]:self.edgestart[i+1],:2]
+
+	def transformed(self, dx=0, dy=0, scale=1, origin=(0,0)):
+
+		"""
+		Returns a copy of the aoiset that is scaled around an origin, and
+		then shifted, e.g. to place an AOI template around a different
+		centre on every trial
+
+		Keyword arguments:
+		dx		--	the horizontal shift (default=0)
+		dy		--	the vertical shift (default=0)
+		scale		--	the scale factor, which needs to be larger than
+					zero (default=1)
+		origin		--	the (x,y) position that is kept in place by
+					scaling (default=(0,0))
+
+		Returns:
+		An aoiset
+		"""
+
+		if not scale > 0:
+			raise ValueError(u'the scale of an AOI template should be larger than zero, not %s' % scale)
+		ox, oy = origin
+		# x' = ox + (x-ox)*scale + dx for every coordinate, and the radii
+		# are only scaled; the coordinates of all AOIs (and of all polygon
+		# edges) are transformed in one operation
+		fields = [u'lx', u'rx', u'ty', u'by', u'cx', u'cy', u'ax', u'ay']
+		shiftx = ox * (1 - scale) + dx
+		shifty = oy * (1 - scale) + dy
+		coords = numpy.column_stack([self.table[f] for f in fields]) * scale \
+			+ (shiftx, shiftx, shifty, shifty, shiftx, shifty, 0, 0)
+		table = self.table.copy()
+		for i in range(len(fields)):
+			table[fields[i]] = coords[:,i]
+		edges = self.edges * scale + (shiftx, shifty, shiftx, shifty)
+
+		return aoiset(names=self.names, table=table, edges=edges, \
+			nedges=numpy.diff(self.edgestart))
+
+	def _compile(self, aoidict):
+
+		"""Compiles a dict of AOI definitions; for internal use"""
+
+		names = numpy.array(list(aoidict.keys()))
+		n = len(names)
+		table = numpy.zeros(n, dtype=self.DTYPE)
+		# polygon edges, as (x0, y0, x1, y1) rows that are sorted by AOI
+		edges = [numpy.zeros((0,4))]
+		nedges = numpy.zeros(n, dtype=int)
+
+		for i in range(n):
+			shape, params = parse_aoi(aoidict[names[i]])
+			record = table[i]
+			record['shape'] = shape
+			if shape == POLYGON:
+				vertices = numpy.array(params, dtype=float)
+				record['lx'], record['ty'] = vertices.min(axis=0)
+				record['rx'], record['by'] = vertices.max(axis=0)
+				edges.append(numpy.hstack((vertices, \
+					numpy.roll(vertices, -1, axis=0))))
+				nedges[i] = len(vertices)
+			else:
+				x, y, w, h = params
+				record['lx'], record['rx'] = x, x + w
+				record['ty'], record['by'] = y, y + h
+				record['cx'], record['cy'] = x + w/2.0, y + h/2.0
+				record['ax'], record['ay'] = w/2.0, h/2.0
+
+		return names, table, numpy.vstack(edges), nedges
+
+	def __len__(self):
+
+		return len(self.names)
+
+	def hits(self, fx, fy, candidates=None):
+
+		"""
+		Returns the AOIs that contain a position
+
+		Arguments:
+		fx		--	x coordinate
+		fy		--	y coordinate
+
+		Keyword arguments:
+		candidates	--	an array with the indices of the AOIs to test, or
+					None to test all AOIs (default=None)
+
+		Returns:
+		An array with the indices of the AOIs that contain the position
+		"""
+
+		if candidates is None:
+			hit = numpy.flatnonzero(hittest(self.lx, self.rx, self.ty, \
+				self.by, fx, fy))
+		else:
+			hit = candidates[hittest(self.lx[candidates], \
+				self.rx[candidates], self.ty[candidates], \
+				self.by[candidates], fx, fy)]
+		if self.rectsonly or len(hit) == 0:
+			return hit
+
+		# test the shapes of the ellipses and polygons whose bounding boxes
+		# contain the position
+		shape = self.shape[hit]
+		keep = shape == RECT
+		ellipses = shape == ELLIPSE
+		if ellipses.any():
+			i = hit[ellipses]
+			keep[ellipses] = self._inellipses(i, fx, fy)
+		polygons = shape == POLYGON
+		if polygons.any():
+			i = hit[polygons]
+			keep[polygons] = self._inpolygons(i, fx, fy)
+
+		return hit[keep]
+
+	def mask(self, i, xs, ys):
+
+		"""
+		Returns which points of a grid an AOI contains
+
+		Arguments:
+		i		--	the index of the AOI
+		xs		--	an array of the grid's x coordinates
+		ys		--	an array of the grid's y coordinates
+
+		Returns:
+		A len(ys) x len(xs) boolean array
+		"""
+
+		cols = (self.lx[i] < xs) == (self.rx[i] > xs)
+		rows = (self.by[i] < ys) == (self.ty[i] > ys)
+		mask = rows[:,numpy.newaxis] & cols[numpy.newaxis,:]
+		if self.shape[i] == ELLIPSE:
+			mask &= self._inellipses(i, xs[numpy.newaxis,:], \
+				ys[:,numpy.newaxis])
+		elif self.shape[i] == POLYGON:
+			inside = numpy.zeros(mask.shape, dtype=bool)
+			xs, ys = xs[numpy.newaxis,:], ys[:,numpy.newaxis]
+			for x0, y0, x1, y1 in \
+				self.edges[self.edgestart[i]:self.edgestart[i+1]]:
+				inside ^= self._crossings(x0, y0, x1, y1, xs, ys)
+			mask &= inside
+
+		return mask
+
+	def _inellipses(self, i, fx, fy):
+
+		"""Tests positions against ellipses; for internal use"""
+
+		err = numpy.seterr(divide='ignore', invalid='ignore')
+		inside = ((fx-self.cx[i]) / self.ax[i])**2 + \
+			((fy-self.cy[i]) / self.ay[i])**2 <= 1
+		numpy.seterr(**err)
+
+		return inside
+
+	def _inpolygons(self, polygons, fx, fy):
+
+		"""Tests a position, or one position per polygon, against polygons,
+		by counting the polygon edges that a ray from the position crosses;
+		for internal use"""
+
+		start = self.edgestart[polygons]
+		nedges = self.edgestart[polygons+1] - start
+		offset = numpy.arange(nedges.sum()) - numpy.repeat(numpy.cumsum( \
+			nedges) - nedges, nedges)
+		x0, y0, x1, y1 = self.edges[numpy.repeat(start, nedges) + offset].T
+		if numpy.ndim(fx) > 0:
+			fx, fy = numpy.repeat(fx, nedges), numpy.repeat(fy, nedges)
+		crossings = self._crossings(x0, y0, x1, y1, fx, fy)
+		owner = numpy.repeat(numpy.arange(len(polygons)), nedges)
+
+		return numpy.bincount(owner[crossings], \
+			minlength=len(polygons)) % 2 == 1
+
+	def _crossings(self, x0, y0, x1, y1, fx, fy):
+
+		"""Returns whether rays that run to the right of positions cross
+		edges; for internal use"""
+
+		err = numpy.seterr(divide='ignore', invalid='ignore')
+		crossings = ((y0 > fy) != (y1 > fy)) & \
+			(fx < x0 + (fy-y0) * (x1-x0) / (y1-y0))
+		numpy.seterr(**err)
+
+		return crossings
+
+
+class bruteforce(object):
+
+	"""Finds the AOIs that contain a position by testing every AOI"""
+
+	def __init__(self, aois):
+
+		"""
+		Constructor
+
+		Arguments:
+		aois		--	an aoiset
+		"""
+
+		self.aois = aois
+
+	def hits(self, fx, fy):
+
+		"""
+		Returns the AOIs that contain a position
+
+		Arguments:
+		fx		--	x coordinate
+		fy		--	y coordinate
+
+		Returns:
+		An array with the indices of the AOIs that contain the position
+		"""
+
+		return self.aois.hits(fx, fy)
+
+
+class gridindex(bruteforce):
+
+	"""Finds the AOIs that contain a position with a uniform grid of
+	buckets, so that only the AOIs that overlap the position's grid cell
+	are tested; the results are identical to those of bruteforce"""
+
+	def __init__(self, aois, resolution, cellsize=None):
+
+		"""
+		Constructor
+
+		Arguments:
+		aois		--	an aoiset
+		resolution	--	the (width,height) of the display
+
+		Keyword arguments:
+		cellsize	--	the width and height of a grid cell in pixels;
+					None uses the median AOI size (default=None)
+		"""
+
+		bruteforce.__init__(self, aois)
+		w, h = resolution
+		x0, x1 = numpy.minimum(aois.lx, aois.rx), numpy.maximum(aois.lx, aois.rx)
+		y0, y1 = numpy.minimum(aois.ty, aois.by), numpy.maximum(aois.ty, aois.by)
+		if cellsize == None:
+			if len(aois) > 0:
+				cellsize = numpy.median(numpy.maximum(x1-x0, y1-y0))
+			else:
+				cellsize = max(w, h)
+		self.cellsize = int(min(max(cellsize, 8), max(w, h)))
+		self.ncols = w // self.cellsize + 1
+		self.nrows = h // self.cellsize + 1
+
+		# the cells that every AOI's bounding box overlaps; AOIs (and later
+		# positions) beyond the display are clipped into the border cells
+		c0, c1 = self._col(x0), self._col(x1)
+		r0, r1 = self._row(y0), self._row(y1)
+		ncells = (c1-c0+1) * (r1-r0+1)
+		owners = numpy.repeat(numpy.arange(len(aois)), ncells)
+		k = numpy.arange(len(owners)) - numpy.repeat(numpy.cumsum(ncells) - \
+			ncells, ncells)
+		width = numpy.repeat(c1-c0+1, ncells)
+		cells = (r0[owners] + k//width) * self.ncols + c0[owners] + k%width
+
+		# buckets, stored as one array of AOI indices sorted by cell, and
+		# the position in that array where every cell starts
+		order = numpy.argsort(cells, kind='mergesort')
+		self.items = owners[order]
+		self.start = numpy.searchsorted(cells[order], \
+			numpy.arange(self.ncols*self.nrows+1))
+
+	def hits(self, fx, fy):
+
+		"""
+		Returns the AOIs that contain a position
+
+		Arguments:
+		fx		--	x coordinate
+		fy		--	y coordinate
+
+		Returns:
+		An array with the indices of the AOIs that contain the position
+		"""
+
+		if not (numpy.isfinite(fx) and numpy.isfinite(fy)):
+			return bruteforce.hits(self, fx, fy)
+		col = min(max(int(fx // self.cellsize), 0), self.ncols-1)
+		row = min(max(int(fy // self.cellsize), 0), self.nrows-1)
+		cell = row * self.ncols + col
+
+		return self.aois.hits(fx, fy, \
+			candidates=self.items[self.start[cell]:self.start[cell+1]])
+
+	def _col(self, x):
+
+		"""Returns the grid column of x coordinates; for internal use"""
+
+		return numpy.clip(numpy.floor_divide(x, self.cellsize), 0, \
+			self.ncols-1).astype(int)
+
+	def _row(self, y):
+
+		"""Returns the grid row of y coordinates; for internal use"""
+
+		return numpy.clip(numpy.floor_divide(y, self.cellsize), 0, \
+			self.nrows-1).astype(int)
+
+
+class rasterindex(bruteforce):
+
+	"""Finds the AOIs that contain a position by looking it up in a raster
+	of labels, with one label for every combination of overlapping AOIs;
+	at a scale of 1, the results are identical to those of bruteforce for
+	whole-pixel positions, and otherwise they are accurate to one raster
+	cell"""
+
+	def __init__(self, aois, resolution, scale=1):
+
+		"""
+		Constructor
+
+		Arguments:
+		aois		--	an aoiset
+		resolution	--	the (width,height) of the display; positions
+					outside of the display are tested against every
+					AOI
+
+		Keyword arguments:
+		scale		--	the width and height of a raster cell in pixels
+					(default=1)
+		"""
+
+		bruteforce.__init__(self, aois)
+		self.scale = scale
+		key = (aoiset_fingerprint(aois.shape, aois.lx, aois.rx, aois.ty, \
+			aois.by, aois.edges), tuple(resolution), scale)
+		if key in _rastercache:
+			self.raster, self.sets = _rastercache.pop(key)
+		else:
+			self.raster, self.sets = self._build(resolution)
+		_rastercache[key] = self.raster, self.sets
+		while len(_rastercache) > RASTERCACHESIZE:
+			_rastercache.popitem(last=False)
+
+	def hits(self, fx, fy):
+
+		"""
+		Returns the AOIs that contain a position
+
+		Arguments:
+		fx		--	x coordinate
+		fy		--	y coordinate
+
+		Returns:
+		An array with the indices of the AOIs that contain the position
+		"""
+
+		if not (numpy.isfinite(fx) and numpy.isfinite(fy)):
+			return bruteforce.hits(self, fx, fy)
+		col = int(fx // self.scale)
+		row = int(fy // self.scale)
+		nrows, ncols = self.raster.shape
+		if col < 0 or col >= ncols or row < 0 or row >= nrows:
+			return bruteforce.hits(self, fx, fy)
+
+		return self.sets[self.raster[row,col]]
+
+	def _build(self, resolution):
+
+		"""
+		Builds the label raster; for internal use
+
+		Returns:
+		A (raster, sets) tuple, where raster is a 2D array of labels, and
+		sets is a list with, for every label, an array with the indices of
+		the AOIs that it stands for (label 0 stands for no AOI)
+		"""
+
+		w, h = resolution
+		ncols = -(-w // self.scale)
+		nrows = -(-h // self.scale)
+		# every cell is represented by (the pixel at) its centre
+		xs = numpy.arange(ncols) * self.scale + (self.scale - 1) / 2.0
+		ys = numpy.arange(nrows) * self.scale + (self.scale - 1) / 2.0
+
+		raster = numpy.zeros((nrows,ncols), dtype=numpy.int32)
+		sets = [()]
+		labels = {(): 0}
+		aois = self.aois
+		for i in range(len(aois)):
+			# the cells within the AOI's borders or bounding box
+			cols = numpy.flatnonzero((aois.lx[i] < xs) == (aois.rx[i] > xs))
+			rows = numpy.flatnonzero((aois.by[i] < ys) == (aois.ty[i] > ys))
+			if len(cols) == 0 or len(rows) == 0:
+				continue
+			c0, c1, r0, r1 = cols[0], cols[-1]+1, rows[0], rows[-1]+1
+			area = raster[r0:r1,c0:c1]
+			inside = aois.mask(i, xs[c0:c1], ys[r0:r1])
+			# relabel every combination of AOIs in the area, adding this AOI
+			old, inverse = numpy.unique(area[inside], return_inverse=True)
+			new = numpy.zeros(len(old), dtype=numpy.int32)
+			for j in range(len(old)):
+				combination = sets[old[j]] + (i,)
+				if combination not in labels:
+					labels[combination] = len(sets)
+					sets.append(combination)
+				new[j] = labels[combination]
+			area[inside] = new[inverse]
+
+		# a compact label type
+		if len(sets) <= 2**8:
+			raster = raster.astype(numpy.uint8)
+		elif len(sets) <= 2**16:
+			raster = raster.astype(numpy.uint16)
+		sets = [numpy.array(combination, dtype=int) for combination in sets]
+
+		return raster, sets
+
+
+class placedindex(object):
+
+	"""Finds the AOIs of a template that is placed with an offset and a
+	scale (as by aoiset.transformed), by mapping positions back into the
+	template's coordinates, so that the template's own hit-test engine is
+	used for every placement, rather than building one per placement; a
+	rasterindex is then accurate to one raster cell of the template"""
+
+	def __init__(self, index, dx=0, dy=0, scale=1, origin=(0,0)):
+
+		"""
+		Constructor
+
+		Arguments:
+		index		--	a hit-test engine for the template's aoiset
+
+		Keyword arguments:
+		dx		--	the horizontal shift (default=0)
+		dy		--	the vertical shift (default=0)
+		scale		--	the scale factor, which needs to be larger than
+					zero (default=1)
+		origin		--	the (x,y) position that is kept in place by
+					scaling (default=(0,0))
+		"""
+
+		if not scale > 0:
+			raise ValueError(u'the scale of an AOI template should be larger than zero, not %s' % scale)
+		ox, oy = origin
+		self.index = index
+		self.aois = index.aois
+		self.scale = float(scale)
+		self.shiftx = ox * (1 - scale) + dx
+		self.shifty = oy * (1 - scale) + dy
+
+	def position(self, fx, fy):
+
+		"""
+		Returns a position in the template's coordinates
+
+		Arguments:
+		fx		--	x coordinate
+		fy		--	y coordinate
+
+		Returns:
+		An (x,y) tuple
+		"""
+
+		return (fx - self.shiftx) / self.scale, (fy - self.shifty) / self.scale
+
+	def hits(self, fx, fy):
+
+		"""
+		Returns the AOIs that contain a position
+
+		Arguments:
+		fx		--	x coordinate
+		fy		--	y coordinate
+
+		Returns:
+		An array with the indices of the AOIs that contain the position
+		"""
+
+		return self.index.hits(*self.position(fx, fy))
+
+
+def classify(aois, positions, durations=None, chunksize=None):
+
+	"""Classifies a whole array of fixations at once, without OpenSesame;
+	every fixation counts for each of the AOIs that contain it, as in the
+	aoi item, except for fixations with a missing (non-finite) position,
+	which count for no AOI
+
+	arguments
+	aois		--	an aoiset, e.g. aoiset(aoidict)
+	positions	--	an N x 2 array of (x,y) fixation positions
+
+	keyword arguments
+	durations	--	an array of N fixation durations, or None to count
+				fixations only (default = None)
+	chunksize	--	the number of fixations that are tested at once;
+				None keeps every chunk at about 4 million
+				fixation-AOI pairs (default = None)
+
+	returns
+	counts, dwell, labels	--	an array with the number of fixations
+				in every AOI, an array with the summed durations of
+				those fixations (zeros when durations is None), and an
+				array with, for every fixation, the index of the first
+				AOI (in aois.names) that contains it, or -1 for none
+	"""
+
+	positions = numpy.asarray(positions, dtype=float).reshape(-1, 2)
+	n, k = len(positions), len(aois)
+	if durations is None:
+		durations = numpy.zeros(n)
+	else:
+		durations = numpy.asarray(durations, dtype=float)
+		if durations.shape != (n,):
+			raise ValueError(u"expected %d fixation durations, not %d" % \
+				(n, durations.size))
+	if chunksize is None:
+		chunksize = max(2**22 // max(k, 1), 1)
+
+	counts = numpy.zeros(k, dtype=int)
+	dwell = numpy.zeros(k)
+	labels = numpy.empty(n, dtype=int)
+	for start in range(0, n, chunksize):
+		fx = positions[start:start+chunksize,0:1]
+		fy = positions[start:start+chunksize,1:2]
+		inside = hittest(aois.lx, aois.rx, aois.ty, aois.by, fx, fy)
+		inside &= numpy.isfinite(fx) & numpy.isfinite(fy)
+		if not aois.rectsonly:
+			# test the shapes of the ellipses and polygons only for the
+			# fixations within their bounding boxes
+			rows, cols = numpy.nonzero(inside)
+			shape = aois.shape[cols]
+			keep = shape == RECT
+			i = shape == ELLIPSE
+			keep[i] = aois._inellipses(cols[i], fx[rows[i],0], fy[rows[i],0])
+			i = shape == POLYGON
+			keep[i] = aois._inpolygons(cols[i], fx[rows[i],0], fy[rows[i],0])
+			inside[rows[~keep],cols[~keep]] = False
+		counts += inside.sum(axis=0)
+		dwell += numpy.dot(durations[start:start+chunksize], inside)
+		if k > 0:
+			labels[start:start+chunksize] = numpy.where(inside.any(axis=1), \
+				inside.argmax(axis=1), -1)
+		else:
+			labels[start:start+chunksize] = -1
+
+	return counts, dwell, labels
+
+
+class aoimetrics(object):
+
+	"""Keeps per-AOI fixation metrics up to date while fixations come in,
+	in arrays that are allocated once; transitions count every pair of
+	consecutive fixations by the first AOI that contains them (or naois
+	for fixations outside of all AOIs), and are kept sparsely, because only
+	a few of the pairs of a large AOI set occur in a trial"""
+
+	def __init__(self, naois):
+
+		"""
+		Constructor
+
+		Arguments:
+		naois		--	the number of AOIs
+		"""
+
+		self.naois = naois
+		self.dwell = numpy.zeros(naois)
+		self.firstfix = numpy.zeros(naois)
+		self.firstfixdur = numpy.zeros(naois)
+		self.revisits = numpy.zeros(naois, dtype=int)
+		# transition counts, keyed by (from, to)
+		self.transitions = collections.Counter()
+		self.current = numpy.zeros(naois, dtype=bool)
+		self.previous = numpy.zeros(naois, dtype=bool)
+		self.visited = numpy.zeros(naois, dtype=bool)
+		self.first = numpy.zeros(naois, dtype=bool)
+		self.reset(0)
+
+	def reset(self, t0):
+
+		"""
+		Clears the metrics at the start of a trial
+
+		Arguments:
+		t0		--	the onset time of the trial
+		"""
+
+		self.t0 = t0
+		self.onset = None
+		self.label = None
+		self.dwell[:] = 0
+		self.firstfix[:] = numpy.nan
+		self.firstfixdur[:] = numpy.nan
+		self.revisits[:] = 0
+		self.transitions.clear()
+		self.current[:] = False
+		self.previous[:] = False
+		self.visited[:] = False
+		self.first[:] = False
+
+	def fixation_start(self, t, hits):
+
+		"""
+		Registers the start of a fixation
+
+		Arguments:
+		t		--	the start time of the fixation
+		hits		--	an array with the indices of the AOIs that
+					contain the fixation
+		"""
+
+		if self.onset is not None:
+			self.fixation_end(t)
+		self.onset = t
+		self.current[:] = False
+		self.current[hits] = True
+		# AOIs that are entered again after gaze has left them
+		self.revisits[self.current & ~self.previous & self.visited] += 1
+		self.first[:] = self.current & ~self.visited
+		self.firstfix[self.first] = t - self.t0
+		self.visited |= self.current
+		if len(hits) > 0:
+			label = min(hits)
+		else:
+			label = self.naois
+		if self.label is not None:
+			self.transitions[self.label, label] += 1
+		self.label = label
+
+	def fixation_end(self, t):
+
+		"""
+		Registers the end of the current fixation; this does nothing when
+		no fixation has started
+
+		Arguments:
+		t		--	the end time of the fixation
+		"""
+
+		if self.onset is None:
+			return
+		duration = t - self.onset
+		self.dwell[self.current] += duration
+		self.firstfixdur[self.first] = duration
+		self.previous[:] = self.current
+		self.first[:] = False
+		self.onset = None
+
+	def transition_counts(self):
+
+		"""
+		Returns the transitions that occurred, sorted by (from, to)
+
+		Returns:
+		Three arrays with the from and to labels (AOI indices, or naois for
+		fixations outside of all AOIs) and the counts of the transitions
+		"""
+
+		pairs = sorted(self.transitions)
+		counts = numpy.array([self.transitions[pair] for pair in pairs], \
+			dtype=int)
+		pairs = numpy.array(pairs, dtype=int).reshape(-1, 2)
+
+		return pairs[:,0], pairs[:,1], counts
+
+
+# fixation detection methods
+IVT = u'ivt'
+IDT = u'idt'
+# the number of samples at which I-DT looks for a fixation start at once
+IDTBLOCK = 1024
+# the time span (in milliseconds) over which I-VT measures velocity
+IVTWINDOW = 20
+
+
+class fixationdetector(object):
+
+	"""Detects fixations in a stream of gaze samples that comes in in chunks,
+	with a velocity threshold (I-VT) or a dispersion threshold (I-DT), and
+	reports them as (timestamp, kind, (x,y)) events, like the tracker's; a
+	fixation start is reported as soon as a fixation has lasted for the
+	minimal duration, with the fixation's onset as its timestamp and the
+	mean position until then, so that the detection delay is the minimal
+	duration plus the time until the next chunk"""
+
+	def __init__(self, method=IVT, threshold=None, mindur=100, \
+		window=IVTWINDOW):
+
+		"""
+		Constructor
+
+		Keyword arguments:
+		method		--	IVT or IDT (default=IVT)
+		threshold	--	the maximal velocity in px/s (I-VT), or the
+					maximal dispersion (the sum of the horizontal and
+					vertical range) in px (I-DT); None uses 1000 px/s
+					or 50 px (default=None)
+		mindur		--	the minimal fixation duration in milliseconds
+					(default=100)
+		window		--	the time span in milliseconds over which I-VT
+					measures velocity, so that neither sample noise
+					nor samples that are polled more often than the
+					tracker updates them inflate it (default=IVTWINDOW)
+		"""
+
+		if method not in [IVT, IDT]:
+			raise ValueError(u"unknown fixation detection method '%s'" % \
+				method)
+		if threshold is None:
+			if method == IVT:
+				threshold = 1000
+			else:
+				threshold = 50
+		self.method = method
+		self.threshold = threshold
+		self.mindur = mindur
+		self.window = window
+		self.reset()
+
+	def reset(self):
+
+		"""Forgets all samples"""
+
+		# the current (I-VT: possible) fixation, as [onset, last sample
+		# time, x sum, y sum, sample count, reported, x min, x max, y min,
+		# y max], or None
+		self.fixation = None
+		# the newest samples, over which velocity is measured (I-VT), or
+		# the samples that may start a fixation once more samples are in
+		# (I-DT)
+		self.previous = numpy.zeros((0,3))
+		self.tail = numpy.zeros((0,3))
+
+	def update(self, samples):
+
+		"""
+		Detects fixations in new samples
+
+		Arguments:
+		samples		--	an n x 3 array of (timestamp, x, y) rows, e.g.
+					from a gazesampler; missing samples (NaN) end
+					fixations
+
+		Returns:
+		A list of (timestamp, kind, (x,y)) events, where kind is
+		u'fixation_start' or u'fixation_end'
+		"""
+
+		samples = numpy.asarray(samples, dtype=float).reshape(-1, 3)
+		if self.method == IVT:
+			return self._ivt(samples)
+		return self._idt(samples)
+
+	def flush(self):
+
+		"""
+		Ends the current fixation, e.g. at the end of a recording
+
+		Returns:
+		A list of events, as returned by update()
+		"""
+
+		events = []
+		if self.fixation != None and self.fixation[5]:
+			events.append(self._end())
+		self.reset()
+
+		return events
+
+	def _ivt(self, samples):
+
+		"""Detects fixations with a velocity threshold; for internal use"""
+
+		events = []
+		if len(samples) == 0:
+			return events
+		t, x, y = samples.T
+		# the velocity of every sample, relative to the newest sample that
+		# is at least a window older (or to the oldest sample, at the start
+		# of a recording); samples without an older one may start a
+		# fixation
+		history = numpy.vstack((self.previous, samples))
+		i = numpy.searchsorted(history[:,0], t - self.window, side='right') - 1
+		prev = history[numpy.maximum(i, 0)]
+		err = numpy.seterr(divide='ignore', invalid='ignore')
+		velocity = 1000 * numpy.hypot(x-prev[:,1], y-prev[:,2]) / (t-prev[:,0])
+		numpy.seterr(**err)
+		slow = (velocity < self.threshold) | (t == prev[:,0])
+		slow &= numpy.isfinite(x) & numpy.isfinite(y)
+		# only the samples that later samples can be measured against are
+		# kept
+		i = numpy.searchsorted(history[:,0], t[-1] - self.window, \
+			side='right') - 1
+		self.previous = history[max(i, 0):]
+
+		# runs of slow (fixation) and fast (saccade or missing) samples
+		bounds = numpy.flatnonzero(slow[1:] != slow[:-1]) + 1
+		starts = numpy.concatenate(([0], bounds))
+		ends = numpy.concatenate((bounds, [len(samples)]))
+		for a, b in zip(starts, ends):
+			if not slow[a]:
+				if self.fixation != None and self.fixation[5]:
+					events.append(self._end())
+				self.fixation = None
+				continue
+			if self.fixation == None:
+				self.fixation = [t[a], t[a], 0, 0, 0, False, 0, 0, 0, 0]
+			fixation = self.fixation
+			if not fixation[5] and t[b-1] - fixation[0] >= self.mindur:
+				# the sample at which the fixation lasted long enough
+				k = a + numpy.searchsorted(t[a:b], fixation[0] + self.mindur)
+				n = fixation[4] + k+1-a
+				events.append((fixation[0], u'fixation_start', \
+					((fixation[2] + x[a:k+1].sum()) / n, \
+					(fixation[3] + y[a:k+1].sum()) / n)))
+				fixation[5] = True
+			fixation[1] = t[b-1]
+			fixation[2] += x[a:b].sum()
+			fixation[3] += y[a:b].sum()
+			fixation[4] += b-a
+
+		return events
+
+	def _idt(self, samples):
+
+		"""Detects fixations with a dispersion threshold; for internal use"""
+
+		events = []
+		data = numpy.vstack((self.tail, samples))
+		self.tail = numpy.zeros((0,3))
+		n = len(data)
+		if n == 0:
+			return events
+		t, x, y = data.T
+		# the last sample of the shortest window that starts at every sample
+		# and lasts for the minimal duration (n if there is none yet)
+		last = numpy.searchsorted(t, t + self.mindur)
+		ranges = None
+		i = 0
+		while i < n:
+			if self.fixation != None:
+				# extend the fixation until the dispersion gets too large
+				fixation = self.fixation
+				minx = numpy.minimum.accumulate(numpy.minimum(x[i:], \
+					fixation[6]))
+				maxx = numpy.maximum.accumulate(numpy.maximum(x[i:], \
+					fixation[7]))
+				miny = numpy.minimum.accumulate(numpy.minimum(y[i:], \
+					fixation[8]))
+				maxy = numpy.maximum.accumulate(numpy.maximum(y[i:], \
+					fixation[9]))
+				inside = (maxx-minx) + (maxy-miny) <= self.threshold
+				if inside.all():
+					j = n
+				else:
+					j = i + numpy.argmin(inside)
+				if j > i:
+					fixation[1] = t[j-1]
+					fixation[2] += x[i:j].sum()
+					fixation[3] += y[i:j].sum()
+					fixation[4] += j-i
+					fixation[6:10] = minx[j-i-1], maxx[j-i-1], \
+						miny[j-i-1], maxy[j-i-1]
+				if j < n:
+					events.append(self._end())
+					self.fixation = None
+				i = j
+				continue
+
+			# the first window from i onwards with a small enough dispersion,
+			# searched for in blocks of windows
+			if ranges == None:
+				ranges = [_rangetable(x), _rangetable(y)]
+			found = None
+			while found == None:
+				first = numpy.arange(i, min(i+IDTBLOCK, n))
+				complete = last[first] < n
+				if not complete.any():
+					break
+				first = first[complete]
+				dispersion = _range(ranges[0], first, last[first]) + \
+					_range(ranges[1], first, last[first])
+				candidates = numpy.flatnonzero(dispersion <= self.threshold)
+				if len(candidates) > 0:
+					found = first[candidates[0]]
+				else:
+					i = first[-1] + 1
+			if found == None:
+				# samples that may still start a fixation with the next
+				# samples
+				self.tail = data[i:]
+				break
+			a, b = found, last[found]+1
+			self.fixation = [t[a], t[b-1], x[a:b].sum(), y[a:b].sum(), b-a, \
+				True, x[a:b].min(), x[a:b].max(), y[a:b].min(), y[a:b].max()]
+			events.append((t[a], u'fixation_start', \
+				(x[a:b].mean(), y[a:b].mean())))
+			i = b
+
+		return events
+
+	def _end(self):
+
+		"""Returns the end event of the current fixation; for internal
+		use"""
+
+		fixation = self.fixation
+
+		return fixation[1], u'fixation_end', (fixation[2] / fixation[4], \
+			fixation[3] / fixation[4])
+
+
+def detect_fixations(samples, method=IVT, threshold=None, mindur=100, \
+	window=IVTWINDOW):
+
+	"""Detects the fixations in recorded gaze samples
+
+	arguments
+	samples	--	an n x 3 array of (timestamp, x, y) rows
+
+	keyword arguments
+	method		--	IVT or IDT (default = IVT)
+	threshold	--	see fixationdetector (default = None)
+	mindur		--	the minimal fixation duration in milliseconds
+				(default = 100)
+	window		--	see fixationdetector (default = IVTWINDOW)
+
+	returns
+	fixations	--	an n x 5 array of (start, end, duration, x, y) rows
+	"""
+
+	detector = fixationdetector(method, threshold=threshold, mindur=mindur, \
+		window=window)
+	events = []
+	# in chunks, which bounds the memory use of I-DT
+	for i in range(0, len(samples), 65536):
+		events.extend(detector.update(samples[i:i+65536]))
+
+	return fixation_table(events + detector.flush())
+
+
+def fixation_table(events):
+
+	"""Pairs fixation start and end events
+
+	arguments
+	events		--	a list of (timestamp, kind, (x,y)) events, as
+				returned by a fixationdetector
+
+	returns
+	fixations	--	an n x 5 array of (start, end, duration, x, y) rows,
+				for the fixations that both start and end in events
+	"""
+
+	fixations = []
+	onset = None
+	for t, kind, (x, y) in events:
+		if kind == u'fixation_start':
+			onset = t
+		elif onset is not None:
+			fixations.append((onset, t, t-onset, x, y))
+			onset = None
+
+	return numpy.array(fixations, dtype=float).reshape(-1, 5)
+
+
+def _rangetable(values):
+
+	"""Returns a sparse table of the minima and maxima of values, over
+	windows of 1, 2, 4, ... values; for internal use"""
+
+	table = [(values, values)]
+	width = 1
+	while 2*width <= len(values):
+		mins, maxs = table[-1]
+		table.append((numpy.minimum(mins[:-width], mins[width:]), \
+			numpy.maximum(maxs[:-width], maxs[width:])))
+		width *= 2
+
+	return table
+
+
+def _range(table, first, last):
+
+	"""Returns the ranges (maximum minus minimum) of
+	values[first[i]:last[i]+1], from a _rangetable; for internal use"""
+
+	length = last - first + 1
+	# the largest power of two that fits in every window; two windows of
+	# that width cover it
+	level = numpy.searchsorted(2**numpy.arange(len(table)), length, \
+		side='right') - 1
+	ranges = numpy.empty(len(first))
+	for p in numpy.unique(level):
+		i = level == p
+		mins, maxs = table[p]
+		a, b = first[i], last[i] - 2**p + 1
+		ranges[i] = numpy.maximum(maxs[a], maxs[b]) - \
+			numpy.minimum(mins[a], mins[b])
+
+	return ranges
+
+
+class crossingdetector(object):
+
+	"""Classifies every gaze sample, and reports when gaze enters or exits
+	an AOI, with two kinds of hysteresis against jitter at AOI borders:
+	gaze only exits an AOI once it is more than a margin (horizontally or
+	vertically) away from it, and an enter or exit is only reported once
+	it has lasted for a delay"""
+
+	def __init__(self, aois, index, margin=0, delay=0, events=None):
+
+		"""
+		Constructor
+
+		Arguments:
+		aois		--	an aoiset
+		index		--	a hit-test engine for the aoiset, e.g. a
+					gridindex, or a placedindex for a placed
+					template
+
+		Keyword arguments:
+		margin		--	the spatial hysteresis in pixels (default=0)
+		delay		--	the temporal hysteresis in milliseconds
+					(default=0)
+		events		--	a queue to which (timestamp, kind, name)
+					tuples are put, where kind is u'enter' or u'exit'
+					and timestamp is that of the first sample of the
+					enter or exit; None creates a new queue
+					(default=None)
+		"""
+
+		self.aois = aois
+		# samples are mapped into the coordinates of a placed template once,
+		# and then tested with the template's own engine
+		if isinstance(index, placedindex):
+			self.placement = index
+			index = index.index
+			margin = margin / self.placement.scale
+		else:
+			self.placement = None
+		self.index = index
+		self.margin = margin
+		self.delay = delay
+		if events is None:
+			events = queue.Queue()
+		self.events = events
+		# the sample offsets at which gaze is still close to an AOI
+		self.offsets = [(-margin,0), (margin,0), (0,-margin), (0,margin)]
+		self.state = numpy.zeros(len(aois), dtype=bool)
+		self.raw = numpy.zeros(len(aois), dtype=bool)
+		self.pending = numpy.zeros(len(aois))
+		self.reset()
+
+	def reset(self):
+
+		"""Sets gaze to be outside of all AOIs, and empties the event
+		queue"""
+
+		self.state[:] = False
+		self.pending[:] = numpy.nan
+		while not self.events.empty():
+			self.events.get()
+
+	def sample(self, t, x, y):
+
+		"""
+		Classifies a gaze sample; this can be used as the callback of a
+		gazesampler
+
+		Arguments:
+		t		--	the timestamp of the sample
+		x		--	x coordinate
+		y		--	y coordinate
+		"""
+
+		self.raw[:] = False
+		if numpy.isfinite(x) and numpy.isfinite(y):
+			if self.placement != None:
+				x, y = self.placement.position(x, y)
+			self.raw[self.index.hits(x, y)] = True
+			# gaze that is close to an AOI that it is in, stays in it
+			if self.margin > 0:
+				close = numpy.flatnonzero(self.state & ~self.raw)
+				for dx, dy in self.offsets:
+					if len(close) == 0:
+						break
+					hit = self.aois.hits(x+dx, y+dy, candidates=close)
+					self.raw[hit] = True
+					close = close[~self.raw[close]]
+
+		changed = self.raw != self.state
+		self.pending[~changed] = numpy.nan
+		self.pending[changed & numpy.isnan(self.pending)] = t
+		report = numpy.flatnonzero(changed & (t - self.pending >= self.delay))
+		for i in report:
+			self.state[i] = self.raw[i]
+			if self.state[i]:
+				kind = u'enter'
+			else:
+				kind = u'exit'
+			self.events.put((float(self.pending[i]), kind, self.aois.names[i]))
+			self.pending[i] = numpy.nan
+
+
+class heatmap(object):
+
+	"""A duration-weighted density grid of fixations, with one cell for
+	every cellsize x cellsize pixels of the display"""
+
+	def __init__(self, resolution, cellsize=10):
+
+		"""
+		Constructor
+
+		Arguments:
+		resolution	--	the (width,height) of the display
+
+		Keyword arguments:
+		cellsize	--	the width and height of a cell in pixels
+					(default=10)
+		"""
+
+		w, h = resolution
+		self.resolution = w, h
+		self.cellsize = cellsize
+		self.grid = numpy.zeros((-(-h // cellsize), -(-w // cellsize)))
+
+	def clear(self):
+
+		"""Removes all fixations"""
+
+		self.grid[:] = 0
+
+	def add(self, x, y, weight=1):
+
+		"""
+		Adds a fixation; fixations beyond the display are ignored
+
+		Arguments:
+		x		--	x coordinate
+		y		--	y coordinate
+
+		Keyword arguments:
+		weight		--	the weight of the fixation, e.g. its duration
+					(default=1)
+		"""
+
+		if not (numpy.isfinite(x) and numpy.isfinite(y)):
+			return
+		row, col = int(y // self.cellsize), int(x // self.cellsize)
+		nrows, ncols = self.grid.shape
+		if 0 <= row < nrows and 0 <= col < ncols:
+			self.grid[row,col] += weight
+
+	def smoothed(self, sigma):
+
+		"""
+		Returns the grid, smoothed with a Gaussian kernel; the kernel is
+		separable, so that the smoothing is one 1-D convolution per
+		dimension, and every fixation keeps its weight
+
+		Arguments:
+		sigma		--	the standard deviation of the kernel in pixels
+
+		Returns:
+		A smoothed copy of the grid
+		"""
+
+		sigma = float(sigma) / self.cellsize
+
+		return _smooth(_smooth(self.grid, 0, sigma), 1, sigma)
+
+
+def save_heatmap(path, density, resolution, cellsize, sigma, trials):
+
+	"""Saves a (smoothed) heatmap density grid, e.g. the sum of those of
+	all trials with a stimulus, in a compressed .npz file
+
+	arguments
+	path		--	the path of the file
+	density	--	the density grid
+	resolution	--	the (width,height) of the display
+	cellsize	--	the cell size of the grid in pixels
+	sigma		--	the smoothing kernel's standard deviation in pixels
+	trials		--	the number of trials in the density grid
+	"""
+
+	numpy.savez_compressed(path, density=density, resolution=resolution, \
+		cellsize=cellsize, sigma=sigma, trials=trials)
+
+
+def sum_heatmaps(paths):
+
+	"""Sums saved heatmaps, e.g. those of all participants for a stimulus
+
+	arguments
+	paths		--	the paths of files that were saved with save_heatmap,
+				with the same resolution, cell size, and smoothing
+
+	returns
+	density, trials	--	the summed density grid, and the total number
+				of trials
+	"""
+
+	density = None
+	trials = 0
+	for path in paths:
+		data = numpy.load(path)
+		if density is None:
+			density = data[u'density'].copy()
+			params = [data[key].tolist() for key in [u'resolution', \
+				u'cellsize', u'sigma']]
+		else:
+			if [data[key].tolist() for key in [u'resolution', u'cellsize', \
+				u'sigma']] != params:
+				raise ValueError(u"the heatmap in %s has a different resolution, cell size, or smoothing" % path)
+			density += data[u'density']
+		trials += int(data[u'trials'])
+
+	return density, trials
+
+
+def _smooth(grid, axis, sigma):
+
+	"""Returns a grid that is smoothed along one axis with a Gaussian
+	kernel; for internal use"""
+
+	n = grid.shape[axis]
+	if sigma <= 0:
+		return grid.copy()
+	kernel, norm = _smoother(n, sigma)
+	r = len(kernel) // 2
+
+	return numpy.apply_along_axis(lambda values: numpy.convolve( \
+		values / norm, kernel)[r:r+n], axis, grid)
+
+
+def _smoother(n, sigma):
+
+	"""Returns a Gaussian kernel that is cut off at four standard
+	deviations (or at the length of the axis), and the sum of the kernel
+	within the axis for every cell; the values of a cell are divided by
+	that sum before smoothing, so that cells near the edges keep their
+	weight; for internal use"""
+
+	key = n, sigma
+	if key not in _smoothers:
+		r = min(int(numpy.ceil(4 * sigma)), n - 1)
+		kernel = numpy.exp(-numpy.arange(-r, r+1)**2 / (2.0 * sigma**2))
+		norm = numpy.convolve(numpy.ones(n), kernel)[r:r+n]
+		_smoothers[key] = kernel, norm
+
+	return _smoothers[key]
+
+
+def aoiset_fingerprint(*arrays):
+
+	"""Returns a fingerprint of the arrays that describe a set of AOIs
+
+	arguments
+	*arrays	--	the arrays, e.g. lx, rx, ty, and by
+
+	returns
+	fingerprint	--	a hexadecimal string
+	"""
+
+	fingerprint = hashlib.md5()
+	for array in arrays:
+		array = numpy.ascontiguousarray(array, dtype=numpy.float64)
+		fingerprint.update(array.tobytes() if hasattr(array, u'tobytes') \
+			else array.tostring())
+
+	return fingerprint.hexdigest()
+
+
+class gazesampler(object):
+
+	"""Polls an eye tracker on a background thread, and keeps the samples in
+	a fixed-size ring buffer"""
+
+	def __init__(self, eyetracker, clock, capacity=8192, interval=0.001, \
+		callback=None):
+
+		"""
+		Constructor
+
+		Arguments:
+		eyetracker	--	an object with a sample() method that returns the
+					current (x,y) gaze position
+		clock		--	a function that returns the current time in
+					milliseconds
+
+		Keyword arguments:
+		capacity	--	the number of samples in the buffer; older
+					samples are overwritten (default=8192)
+		interval	--	the pause between two polls in seconds
+					(default=0.001)
+		callback	--	a function that is called with the timestamp, x,
+					and y of every new sample, on the sampling thread,
+					or None (default=None)
+		"""
+
+		self.eyetracker = eyetracker
+		self.clock = clock
+		self.capacity = capacity
+		self.interval = interval
+		self.callback = callback
+		# one (timestamp, x, y) row per sample; self.count is only
+		# increased after a row has been written, so that readers never
+		# need a lock to see complete samples
+		self.buffer = numpy.zeros((capacity,3))
+		self.count = 0
+		self.error = None
+		self._running = False
+		self._started = threading.Event()
+		self._thread = None
+
+	def start(self):
+
+		"""Starts sampling, and returns once the first sample is in"""
+
+		self.count = 0
+		self.error = None
+		self._running = True
+		self._started.clear()
+		self._thread = threading.Thread(target=self._poll)
+		self._thread.daemon = True
+		self._thread.start()
+		self._started.wait()
+		if self.error != None:
+			raise self.error
+
+	def stop(self):
+
+		"""Stops sampling"""
+
+		self._running = False
+		if self._thread != None:
+			self._thread.join()
+			self._thread = None
+		if self.error != None:
+			raise self.error
+
+	def newest(self):
+
+		"""
+		Returns the newest sample
+
+		Returns:
+		A (timestamp, (x,y)) tuple, or None when there are no samples yet
+		"""
+
+		n = self.count
+		if n == 0:
+			return None
+		t, x, y = self.buffer[(n-1) % self.capacity]
+
+		return t, (x, y)
+
+	def samples(self, since=0):
+
+		"""
+		Returns the samples that came in after a specific sample
+
+		Keyword arguments:
+		since		--	the number of samples that have already been
+					read, as returned by a previous call (default=0)
+
+		Returns:
+		A (samples, count) tuple, where samples is an n x 3 array of
+		(timestamp, x, y) rows, and count should be passed to the next
+		call. Samples that have been overwritten before they could be
+		read are skipped.
+		"""
+
+		n = self.count
+		# the oldest row may be overwritten while it is copied
+		first = max(since, n - self.capacity + 1)
+		i = numpy.arange(first, n) % self.capacity
+
+		return self.buffer[i], n
+
+	def _poll(self):
+
+		"""Fills the buffer; runs on the sampling thread"""
+
+		try:
+			while self._running:
+				x, y = self.eyetracker.sample()
+				t = self.clock()
+				self.buffer[self.count % self.capacity] = (t, x, y)
+				self.count += 1
+				if self.callback != None:
+					self.callback(t, x, y)
+				self._started.set()
+				time.sleep(self.interval)
+		# errors are raised again by start() or stop()
+		except Exception as e:
+			self.error = e
+			self._running = False
+			self._started.set()
+
+
+class canvascache(object):
+
+	"""A least-recently-used cache of prepared canvases (or other objects
+	that are derived from a sketchpad), which is shared by all items of an
+	experiment"""
+
+	def __init__(self, budget):
+
+		"""
+		Constructor
+
+		Arguments:
+		budget		--	the memory budget in bytes; the least recently
+					used entries are dropped when it is exceeded
+		"""
+
+		self.budget = budget
+		self.size = 0
+		self._entries = collections.OrderedDict()
+
+	def get(self, key, source):
+
+		"""
+		Returns a cached object
+
+		Arguments:
+		key		--	the entry's key, e.g. a (kind, sketchpad name) tuple
+		source		--	the sketchpad canvas that the object should have
+					been prepared from; a sketchpad gets a new canvas
+					whenever it is prepared, so entries that were
+					prepared from a different canvas are out of date
+
+		Returns:
+		The cached object, or None if there is no up-to-date entry
+		"""
+
+		entry = self._entries.pop(key, None)
+		if entry == None:
+			return None
+		if entry[0] is not source:
+			self.size -= entry[2]
+			return None
+		# re-inserting marks the entry as the most recently used one
+		self._entries[key] = entry
+
+		return entry[1]
+
+	def put(self, key, source, obj, nbytes):
+
+		"""
+		Adds an object to the cache
+
+		Arguments:
+		key		--	the entry's key
+		source		--	the sketchpad canvas the object was prepared from;
+					the entry keeps a reference to it, so that it
+					cannot be confused with a later canvas
+		obj		--	the object to cache
+		nbytes		--	the (estimated) memory use of the object
+		"""
+
+		if key in self._entries:
+			self.size -= self._entries.pop(key)[2]
+		self._entries[key] = (source, obj, nbytes)
+		self.size += nbytes
+		while self.size > self.budget and len(self._entries) > 1:
+			oldkey, entry = self._entries.popitem(last=False)
+			self.size -= entry[2]
+
+
+class columnstore(object):
+
+	"""An append-only store of per-trial data, for output that is too large
+	to be logged as variables: every column is a binary file of
+	little-endian values in the store's directory, and index.txt lists the
+	rows of every trial, so that trials can be read back lazily, from
+	memory maps, without loading the rest of the store; string columns are
+	stored as numbers that index a table of the column's strings"""
+
+	def __init__(self, path, new=False):
+
+		"""
+		Constructor; opens a store, or creates it if it does not exist
+
+		Arguments:
+		path		--	the path to the store's directory
+
+		Keyword arguments:
+		new		--	True empties an existing store, e.g. when the
+					logfile that it belongs to is written anew
+					(default=False)
+		"""
+
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		if new:
+			for name in os.listdir(path):
+				if name.endswith(u'.txt') or name.endswith(u'.bin'):
+					os.remove(self._file(name))
+		# column names and types, in the order of columns.txt
+		self.columns = collections.OrderedDict()
+		# the strings of string columns, and their numbers
+		self.strings = {}
+		self._codes = {}
+		# (first row, number of rows) tuples, keyed by trial key
+		self.index = collections.OrderedDict()
+		self.rows = 0
+		self._maps = {}
+		if os.path.exists(self._file(u'columns.txt')):
+			f = io.open(self._file(u'columns.txt'), encoding=u'utf-8')
+			for line in f:
+				name, dtype = line.rstrip(u'\n').split(u'\t')
+				if dtype == u'str':
+					self._addstrings(name)
+				else:
+					self.columns[name] = numpy.dtype(str(dtype))
+			f.close()
+		if os.path.exists(self._file(u'index.txt')):
+			f = io.open(self._file(u'index.txt'), encoding=u'utf-8')
+			for line in f:
+				key, first, count = line.rstrip(u'\n').split(u'\t')
+				self.index[key] = int(first), int(count)
+				self.rows = int(first) + int(count)
+			f.close()
+		# a trial is only indexed once all of its columns are written, so
+		# rows beyond the index are from an interrupted append; they are
+		# dropped to keep the columns aligned
+		for name, dtype in self.columns.items():
+			path = self._file(name + u'.bin')
+			if os.path.exists(path) and \
+				os.path.getsize(path) > self.rows * dtype.itemsize:
+				f = open(path, u'r+b')
+				f.truncate(self.rows * dtype.itemsize)
+				f.close()
+
+	def _file(self, name):
+
+		"""Returns the path to a file in the store's directory"""
+
+		return os.path.join(self.path, name)
+
+	def _addstrings(self, name):
+
+		"""Adds a string column, with the strings in its table; for
+		internal use"""
+
+		self.columns[name] = numpy.dtype(u'<i4')
+		self.strings[name] = []
+		self._codes[name] = {}
+		if os.path.exists(self._file(name + u'.txt')):
+			f = io.open(self._file(name + u'.txt'), encoding=u'utf-8')
+			for line in f:
+				self._codes[name][line.rstrip(u'\n')] = \
+					len(self.strings[name])
+				self.strings[name].append(line.rstrip(u'\n'))
+			f.close()
+
+	def _encode(self, name, values):
+
+		"""Returns the numbers of the strings in a string column, and adds
+		new strings to its table; for internal use"""
+
+		values = [value.decode(u'utf-8') if isinstance(value, bytes) else \
+			u'%s' % value for value in values]
+		codes = self._codes[name]
+		new = []
+		for value in values:
+			if value not in codes:
+				if u'\n' in value:
+					raise ValueError( \
+						u'the strings in a column store cannot contain newlines')
+				codes[value] = len(self.strings[name])
+				self.strings[name].append(value)
+				new.append(value)
+		if len(new) > 0:
+			f = io.open(self._file(name + u'.txt'), u'a', encoding=u'utf-8')
+			for value in new:
+				f.write(value + u'\n')
+			f.close()
+
+		return numpy.array([codes[value] for value in values], dtype=u'<i4')
+
+	def _decode(self, name, codes):
+
+		"""Returns the values of a column, with the numbers of a string
+		column replaced by their strings; for internal use"""
+
+		if name not in self.strings:
+			return codes
+
+		# the extra string makes the table a string array when it is empty
+		return numpy.array(self.strings[name] + [u''])[codes]
+
+	def append(self, key, columns):
+
+		"""
+		Appends the rows of a trial
+
+		Arguments:
+		key		--	the trial's key, e.g. its trial number, which
+					should be unique within the store
+		columns		--	a dict of equally long 1-D arrays (or lists),
+					keyed by column name; the first trial sets the
+					columns and their types, and later trials need to
+					have the same columns
+		"""
+
+		key = u'%s' % key
+		if key in self.index:
+			raise ValueError(u'trial %s is already in the store' % key)
+		arrays = {}
+		for name, values in columns.items():
+			arrays[name] = numpy.asarray(values)
+		counts = set(len(values) for values in arrays.values())
+		if len(counts) > 1:
+			raise ValueError(u'the columns of trial %s differ in length' % \
+				key)
+		if len(self.columns) == 0:
+			f = io.open(self._file(u'columns.txt'), u'a', encoding=u'utf-8')
+			for name in sorted(arrays):
+				if arrays[name].dtype.kind in u'SU':
+					f.write(u'%s\tstr\n' % name)
+					self._addstrings(name)
+				else:
+					dtype = arrays[name].dtype.newbyteorder(u'<')
+					f.write(u'%s\t%s\n' % (name, dtype.str))
+					self.columns[name] = dtype
+			f.close()
+		elif set(arrays) != set(self.columns):
+			raise ValueError(u'the columns of trial %s (%s) are not those of the store (%s)' \
+				% (key, u', '.join(sorted(arrays)), \
+				u', '.join(self.columns)))
+		count = counts.pop()
+
+		for name, dtype in self.columns.items():
+			if name in self.strings:
+				values = self._encode(name, arrays[name])
+			else:
+				values = arrays[name].astype(dtype)
+			f = open(self._file(name + u'.bin'), u'ab')
+			values.tofile(f)
+			f.close()
+		f = io.open(self._file(u'index.txt'), u'a', encoding=u'utf-8')
+		f.write(u'%s\t%d\t%d\n' % (key, self.rows, count))
+		f.close()
+		self.index[key] = self.rows, count
+		self.rows += count
+		self._maps = {}
+
+	def keys(self):
+
+		"""Returns the keys of all trials, in the order they were stored"""
+
+		return list(self.index.keys())
+
+	def column(self, name):
+
+		"""
+		Returns a whole column
+
+		Arguments:
+		name		--	the column name
+
+		Returns:
+		A read-only memory map of the column's values, or an array of
+		strings for a string column
+		"""
+
+		return self._decode(name, self._map(name))
+
+	def _map(self, name):
+
+		"""Returns a memory map of a column's file; for internal use"""
+
+		if name not in self._maps:
+			if self.rows == 0:
+				# empty files cannot be memory mapped
+				self._maps[name] = numpy.zeros(0, self.columns[name])
+			else:
+				self._maps[name] = numpy.memmap(self._file(name + u'.bin'), \
+					dtype=self.columns[name], mode=u'r', shape=(self.rows,))
+
+		return self._maps[name]
+
+	def trial(self, key):
+
+		"""
+		Returns the rows of a trial
+
+		Arguments:
+		key		--	the trial's key
+
+		Returns:
+		A dict of 1-D arrays (views of memory maps, or arrays of strings),
+		keyed by column name
+		"""
+
+		first, count = self.index[u'%s' % key]
+
+		return dict((name, self._decode(name, \
+			self._map(name)[first:first+count])) for name in self.columns)
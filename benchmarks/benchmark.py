@@ -0,0 +1,375 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Headless benchmarks for the per-frame and per-fixation hot paths of the
+# FRL and AOI plug-ins. Gaze comes from a stub eye tracker that replays a
+# synthetic or recorded trace, and frames are drawn on PyGame's dummy video
+# driver, so that neither an eye tracker nor a display is needed. OpenSesame
+# itself is not needed either: when it cannot be imported, minimal
+# stand-ins for the modules that frl.py imports are installed.
+#
+# Every result is written as one JSON object per line, e.g.:
+#
+#	python benchmarks/benchmark.py --output results.jsonl
+
+import os
+import sys
+import json
+import time
+import types
+import platform
+import argparse
+import subprocess
+
+# the dummy driver needs to be selected before pygame is initialized
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy
+import pygame
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for plugin in ['frl', 'aoi']:
+	sys.path.insert(0, os.path.join(ROOT, plugin))
+import libfrl
+import libaoi
+
+
+class stubeyetracker(object):
+
+	"""An eye tracker that replays a gaze trace"""
+
+	def __init__(self, trace):
+
+		"""
+		Constructor
+
+		Arguments:
+		trace		--	an n x 2 array of (x,y) gaze positions; the trace
+					is replayed from the start when it runs out
+		"""
+
+		self.trace = trace
+		self.i = 0
+
+	def sample(self):
+
+		"""Returns the next (x,y) gaze position"""
+
+		x, y = self.trace[self.i % len(self.trace)]
+		self.i += 1
+
+		return x, y
+
+
+class stubexperiment(object):
+
+	"""The parts of an experiment that the FRL drawing functions use"""
+
+	def __init__(self, surface):
+
+		self.surface = surface
+		self.background = u'black'
+
+	def resolution(self):
+
+		return self.surface.get_size()
+
+	def time(self):
+
+		return 1000.0 * time.time()
+
+
+class dummycanvas(object):
+
+	"""An offscreen canvas that behaves like the legacy canvas backend"""
+
+	def __init__(self, experiment, bgcolor=(0,0,0)):
+
+		self.experiment = experiment
+		self.bgcolor = pygame.Color(*bgcolor)
+		self.surface = pygame.Surface(experiment.resolution())
+		self.clear()
+
+	def clear(self):
+
+		self.surface.fill(self.bgcolor)
+
+	def show(self):
+
+		self.experiment.surface.blit(self.surface, (0,0))
+		pygame.display.flip()
+		return self.experiment.time()
+
+
+def standins():
+
+	"""Installs minimal stand-ins for the OpenSesame modules that frl.py
+	imports, so that the plug-in's own drawing code can be timed"""
+
+	class runtime_error(Exception):
+		pass
+
+	modules = {}
+	for name in ['openexp', 'openexp.canvas', 'openexp.keyboard', \
+		'libopensesame', 'libopensesame.item', 'libopensesame.exceptions', \
+		'libqtopensesame', 'libqtopensesame.qtplugin']:
+		modules[name] = types.ModuleType(name)
+	modules['openexp.canvas'].canvas = dummycanvas
+	modules['openexp.keyboard'].keyboard = None
+	modules['libopensesame.item'].item = object
+	modules['libopensesame.exceptions'].runtime_error = runtime_error
+	modules['libqtopensesame.qtplugin'].qtplugin = object
+	for name, module in modules.items():
+		if u'.' in name:
+			package, attr = name.rsplit(u'.', 1)
+			setattr(modules[package], attr, module)
+		sys.modules.setdefault(name, module)
+
+
+def synthetic_trace(resolution, n=10000, rate=1000, seed=0):
+
+	"""
+	Returns a gaze trace of fixations (200-400 ms, with 1 px noise) that
+	are connected by 30 ms saccades
+
+	Arguments:
+	resolution	--	a (width,height) tuple
+
+	Keyword arguments:
+	n		--	the number of samples (default=10000)
+	rate		--	the sampling rate in Hz (default=1000)
+	seed		--	the random seed (default=0)
+
+	Returns:
+	An n x 2 array of (x,y) positions
+	"""
+
+	rng = numpy.random.RandomState(seed)
+	w, h = resolution
+	trace = []
+	pos = numpy.array((w/2.0, h/2.0))
+	while len(trace) < n:
+		nfix = int(rng.uniform(0.2, 0.4) * rate)
+		trace.extend(pos + rng.randn(nfix, 2))
+		target = rng.uniform((0,0), (w,h))
+		nsac = int(0.03 * rate)
+		for i in range(nsac):
+			trace.append(pos + (target-pos) * (i+1.0) / nsac)
+		pos = target
+
+	return numpy.array(trace[:n])
+
+
+def bench_frl(frl, tracker, resolution, size, frltype, redraw, nframes):
+
+	"""
+	Times the FRL's PyGame update function
+
+	Returns:
+	The number of frames per second and microseconds per frame
+	"""
+
+	display = pygame.display.set_mode(resolution)
+	experiment = stubexperiment(display)
+
+	# the same properties that frl.prepare() sets for PyGame backends
+	item = frl.frl.__new__(frl.frl)
+	item.experiment = experiment
+	item.time = experiment.time
+	item.cv = dummycanvas(experiment)
+	numpy.random.seed(0)
+	pygame.surfarray.blit_array(item.cv.surface, \
+		numpy.random.randint(0, 2**24, resolution))
+	item.drawcv = dummycanvas(experiment)
+	item.frlcor = frl.pol2car(100, 45)
+	item.overlay = libfrl.aperture_overlay(size, frltype, \
+		item.drawcv.bgcolor, sigma=size/6.0)
+	item.frlrect = item.overlay.get_rect()
+	item.prevrect = None
+	if redraw == u'dirty rectangles':
+		update = item.dirtyupdate
+	else:
+		update = item.pygameupdate
+
+	t0 = time.time()
+	for i in range(nframes):
+		update(tracker.sample())
+	t = time.time() - t0
+
+	return nframes / t, 1e6 * t / nframes
+
+
+def random_aois(resolution, n, shape=u'rect', seed=0):
+
+	"""Returns an aoiset of n random AOIs, which are sized so that together
+	they cover about the display area, like the word or item AOIs of a
+	reading or search display; shape is u'rect', u'ellipse', or u'polygon'
+	(a hexagon)"""
+
+	rng = numpy.random.RandomState(seed)
+	w, h = resolution
+	side = (w * h / float(n)) ** 0.5
+	x = rng.randint(0, w, n)
+	y = rng.randint(0, h, n)
+	aoiw = (side * rng.uniform(0.5, 1.5, n)).astype(int) + 1
+	aoih = (side * rng.uniform(0.5, 1.5, n)).astype(int) + 1
+
+	aoidict = {}
+	for i in range(n):
+		if shape == u'ellipse':
+			aoidict[i] = [u'ellipse', x[i], y[i], aoiw[i], aoih[i]]
+		elif shape == u'polygon':
+			aoidict[i] = [u'polygon', [(x[i] + aoiw[i]*(1+numpy.cos(a))/2.0, \
+				y[i] + aoih[i]*(1+numpy.sin(a))/2.0) for a in \
+				numpy.arange(6) * numpy.pi / 3]]
+		else:
+			aoidict[i] = [x[i], y[i], aoiw[i], aoih[i]]
+
+	return libaoi.aoiset(aoidict)
+
+
+def bench_aoi(tracker, resolution, naois, nfixations, aoiindex, shape):
+
+	"""
+	Times the AOI hit test, using one of the aoi plug-in's index options
+
+	Returns:
+	The number of fixations per second and microseconds per fixation
+	"""
+
+	aois = random_aois(resolution, naois, shape)
+	fixations = [tracker.sample() for i in range(nfixations)]
+	if aoiindex == u'grid':
+		index = libaoi.gridindex(aois, resolution)
+	elif aoiindex == u'raster':
+		index = libaoi.rasterindex(aois, resolution)
+	else:
+		index = libaoi.bruteforce(aois)
+
+	t0 = time.time()
+	for fx, fy in fixations:
+		index.hits(fx, fy)
+	t = time.time() - t0
+
+	return nfixations / t, 1e6 * t / nfixations
+
+
+def bench_classify(tracker, resolution, naois, nfixations, shape):
+
+	"""
+	Times the offline classification of a whole array of fixations
+
+	Returns:
+	The number of fixations per second and microseconds per fixation
+	"""
+
+	aois = random_aois(resolution, naois, shape)
+	positions = numpy.array([tracker.sample() for i in range(nfixations)])
+	durations = numpy.ones(nfixations)
+
+	t0 = time.time()
+	libaoi.classify(aois, positions, durations)
+	t = time.time() - t0
+
+	return nfixations / t, 1e6 * t / nfixations
+
+
+def environment():
+
+	"""Returns the versions that the results depend on"""
+
+	try:
+		commit = subprocess.check_output(['git', 'describe', '--always', \
+			'--dirty'], cwd=ROOT, stderr=subprocess.STDOUT).decode().strip()
+	except Exception:
+		commit = None
+
+	return {
+		'commit': commit,
+		'python': platform.python_version(),
+		'numpy': numpy.__version__,
+		'pygame': pygame.version.ver,
+		'platform': platform.platform(),
+		}
+
+
+def main():
+
+	parser = argparse.ArgumentParser(description=u'Headless benchmarks for the FRL and AOI plug-ins')
+	parser.add_argument('--trace', help=u'a CSV file with a recorded gaze trace, with x and y as the last two columns (default: a synthetic trace)')
+	parser.add_argument('--resolutions', nargs='+', default=['1024x768', '1920x1080'], help=u'display resolutions (default: 1024x768 1920x1080)')
+	parser.add_argument('--sizes', nargs='+', type=int, default=[50, 150, 300, 600], help=u'FRL diameters in pixels (default: 50 150 300 600)')
+	parser.add_argument('--frltypes', nargs='+', default=[u'circle', u'gauss'], help=u'FRL types (default: circle gauss)')
+	parser.add_argument('--frames', type=int, default=300, help=u'frames per FRL benchmark (default: 300)')
+	parser.add_argument('--aois', nargs='+', type=int, default=[1, 10, 100, 1000, 10000], help=u'AOI counts (default: 1 10 100 1000 10000)')
+	parser.add_argument('--shapes', nargs='+', default=[u'rect', u'ellipse', u'polygon'], help=u'AOI shapes (default: rect ellipse polygon)')
+	parser.add_argument('--fixations', type=int, default=2000, help=u'fixations per AOI benchmark (default: 2000)')
+	parser.add_argument('--output', help=u'append the results to this file, rather than printing them')
+	args = parser.parse_args()
+
+	try:
+		import libopensesame
+	except ImportError:
+		standins()
+	import frl
+
+	env = environment()
+	results = []
+	for resolution in args.resolutions:
+		resolution = tuple(int(v) for v in resolution.split(u'x'))
+		if args.trace == None:
+			trace = synthetic_trace(resolution)
+		else:
+			trace = numpy.loadtxt(args.trace, delimiter=',', ndmin=2)[:,-2:]
+		for frltype in args.frltypes:
+			for redraw in [u'full screen', u'dirty rectangles']:
+				for size in args.sizes:
+					fps, us = bench_frl(frl, stubeyetracker(trace), \
+						resolution, size, frltype, redraw, args.frames)
+					results.append({'benchmark': 'frl_update', \
+						'resolution': resolution, 'frltype': frltype, \
+						'redraw': redraw, 'size': size, \
+						'frames_per_sec': fps, 'us_per_op': us})
+		for shape in args.shapes:
+			for aoiindex in [u'none', u'grid', u'raster']:
+				for naois in args.aois:
+					ops, us = bench_aoi(stubeyetracker(trace), resolution, \
+						naois, args.fixations, aoiindex, shape)
+					results.append({'benchmark': 'aoi_hittest', \
+						'resolution': resolution, 'shape': shape, \
+						'aoiindex': aoiindex, 'aois': naois, \
+						'ops_per_sec': ops, 'us_per_op': us})
+			for naois in args.aois:
+				ops, us = bench_classify(stubeyetracker(trace), \
+					resolution, naois, args.fixations, shape)
+				results.append({'benchmark': 'aoi_classify', \
+					'resolution': resolution, 'shape': shape, \
+					'aois': naois, 'ops_per_sec': ops, 'us_per_op': us})
+
+	if args.output == None:
+		out = sys.stdout
+	else:
+		out = open(args.output, 'a')
+	for result in results:
+		result.update(env)
+		out.write(json.dumps(result, sort_keys=True) + '\n')
+	if out is not sys.stdout:
+		out.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -20,7 +20,17 @@ from openexp.keyboard import keyboard
 from libopensesame import item, exceptions
 from libqtopensesame import qtplugin
 
+import os
+import sys
 import math
+import numpy
+import pygame
+
+# helper library, which lives next to this file
+_plugindir = os.path.dirname(os.path.abspath(__file__))
+if _plugindir not in sys.path:
+	sys.path.append(_plugindir)
+import libfrl
 
 def car2pol(x,y):
 	
@@ -120,7 +130,17 @@ class frl(item.item):
 		self.size = 150
 		self.dist = 100
 		self.angle = 45
-		self.frltype = u'circle' # possibly add Gauss and raised cosine in future
+		self.frltype = u'circle'
+		self.sigma = 25
+		self.redraw = u'full screen'
+		self.threshold = 0
+		self.maxstale = 1000
+		self.sampling = u'inline'
+		self.latencylog = u'no'
+		self.prediction = u'none'
+		self.horizon = 20
+		self.prerender = u'no'
+		self.outputmode = u'variables'
 		self.description = \
 			u"Limits canvas visibility using a forced retinal location, until a key is pressed, or a timeout is reached"
 		item.item.__init__(self, name, experiment, string)
@@ -141,9 +161,21 @@ class frl(item.item):
 			raise exceptions.runtime_error( \
 				u"Please connect to the eyetracker using the the eyetracker_calibrate plugin before using the FRL plugin")
 		
-		# canvas
-		self.cv = canvas(self.experiment)
-		self.cv.copy(self.experiment.items[self.get(u'sketchpad')].canvas)
+		# canvas; prepared copies of sketchpads are cached across trials
+		# (and shared with the other FRL items), for as long as the
+		# sketchpad itself is not prepared again
+		if not hasattr(self.experiment, u'frlcanvascache'):
+			self.experiment.frlcanvascache = libfrl.canvascache( \
+				self.get_check(u'canvas_cache_mb', 256) * 1024**2)
+		w, h = self.experiment.resolution()
+		source = self.experiment.items[self.get(u'sketchpad')].canvas
+		self.cv = self.experiment.frlcanvascache.get( \
+			(u'canvas', self.get(u'sketchpad')), source)
+		if self.cv is None:
+			self.cv = canvas(self.experiment)
+			self.cv.copy(source)
+			self.experiment.frlcanvascache.put( \
+				(u'canvas', self.get(u'sketchpad')), source, self.cv, 4*w*h)
 		self.drawcv = canvas(self.experiment)
 		
 		# keyboard
@@ -162,23 +194,99 @@ class frl(item.item):
 		
 		# FRL properties
 		self.frlcor = pol2car(self.get(u'dist'), self.get(u'angle'))
+		if self.get(u'frltype') not in libfrl.FRLTYPES:
+			raise exceptions.runtime_error( \
+				u"Unknown FRL type '%s'" % self.get(u'frltype'))
+		if self.get(u'frltype') != u'circle' and self.get(u'sigma') <= 0:
+			raise exceptions.runtime_error( \
+				u"The FRL edge should be larger than 0 for the '%s' FRL type" % self.get(u'frltype'))
+		
+		# gaze prediction
+		if self.get(u'prediction') not in libfrl.PREDICTORS:
+			raise exceptions.runtime_error( \
+				u"Unknown gaze prediction method '%s'" % self.get(u'prediction'))
+		if self.get(u'prediction') == u'none':
+			self.predictor = None
+		else:
+			self.predictor = libfrl.gazepredictor(self.get(u'prediction'), \
+				self.get(u'horizon'), bounds=self.experiment.resolution())
+		
+		# the gaze samples of every trial can be appended to a column store
+		# next to the logfile, which is kept open by the experiment; like
+		# the logfile, it is written anew for every session
+		if self.get(u'outputmode') == u'column store':
+			path = os.path.splitext(self.experiment.logfile)[0] + \
+				u'_%s_samples' % self.name
+			if not hasattr(self.experiment, u'frlcolumnstores'):
+				self.experiment.frlcolumnstores = {}
+			if path not in self.experiment.frlcolumnstores:
+				self.experiment.frlcolumnstores[path] = \
+					libfrl.columnstore(path, new=True)
+			self.store = self.experiment.frlcolumnstores[path]
+		else:
+			self.store = None
 		
 		# psycho
 		if self.get("canvas_backend") == u'psycho':
+			# the sketchpad can be flattened into a single texture, so that
+			# every frame draws one textured quad, rather than every
+			# sketchpad element; this needs to happen before the Aperture
+			# is created, as an enabled Aperture would clip the texture
+			if self.get(u'prerender') == u'yes':
+				self.texture = self.experiment.frlcanvascache.get( \
+					(u'texture', self.get(u'sketchpad')), source)
+				if self.texture is None:
+					from psychopy.visual import BufferImageStim
+					self.texture = BufferImageStim(self.experiment.window, \
+						stim=self.cv.stim_list)
+					self.experiment.window.clearBuffer()
+					self.experiment.frlcanvascache.put( \
+						(u'texture', self.get(u'sketchpad')), source, \
+						self.texture, 4*w*h)
+				self.stimuli = [self.texture]
+			else:
+				self.texture = None
+				self.stimuli = self.cv.stim_list
 			# create Aperture
 			from psychopy.visual import Aperture
 			self.frl = Aperture(self.experiment.window, self.get(u'size'), pos=pos2psychopos(self.frlcor,self.experiment.resolution()), shape='circle', units='pix')
+			# soft edges are drawn on top of the sketchpad with a stimulus
+			# in the background colour, masked by the (cached) alpha profile
+			if self.get(u'frltype') == u'circle':
+				self.softedge = None
+			else:
+				from psychopy.visual import GratingStim
+				mask = libfrl.aperture_mask(self.get(u'size'), \
+					self.get(u'frltype'), self.get(u'sigma'))
+				bgcolor = pygame.Color(str(self.get(u'background')))
+				self.softedge = GratingStim(self.experiment.window, tex=None, \
+					mask=mask, size=mask.shape, units='pix', \
+					color=tuple(bgcolor)[:3], colorSpace='rgb255')
 			# update function
 			self.updatefunc = self.psychoupdate
 			
 		# legacy and xpyriment
 		elif self.get("canvas_backend") in [u'legacy',u'xpyriment']:
-			# PyGame specific properties
-			self.r = self.get(u'size')/2
-			self.h = 1 # updaterect height; increase to lower FRL resolution (which increases processing speed)
-			# update function
-			self.updatefunc = self.pygameupdate
-			pass
+			# PyGame specific properties; the overlay is cached, so that
+			# it is only built once for every size and FRL type
+			self.overlay = libfrl.aperture_overlay(self.get(u'size'), \
+				self.get(u'frltype'), self.drawcv.bgcolor, \
+				sigma=self.get(u'sigma'))
+			self.frlrect = self.overlay.get_rect()
+			self.prevrect = None
+			# update function; only the legacy backend draws directly to
+			# the display, so dirty rectangles are not used with xpyriment;
+			# nor are they used on double-buffered or hardware displays,
+			# where updating a part of the display flips the whole back
+			# buffer, which still holds the apertures of earlier frames
+			display = pygame.display.get_surface()
+			if self.get(u'redraw') == u'dirty rectangles' and \
+				self.get("canvas_backend") == u'legacy' and \
+				display is not None and not display.get_flags() & \
+				(pygame.DOUBLEBUF | pygame.HWSURFACE):
+				self.updatefunc = self.dirtyupdate
+			else:
+				self.updatefunc = self.pygameupdate
 		
 		# any other backend produces an error
 		else:
@@ -193,27 +301,50 @@ class frl(item.item):
 		
 		# frl position
 		frlpos = (gazepos[0]-self.frlcor[0], gazepos[1]-self.frlcor[1])
+		self.frlrect.center = (int(frlpos[0]), int(frlpos[1]))
 		
 		# clear canvas
 		self.drawcv.clear()
-				
-		# top half
-		for y in range(0,int(self.r/self.h)):
-			y = self.r - y
-			x = (self.r**2-y**2)**0.5
-			updaterect = [frlpos[0]-x,frlpos[1]-self.h*y,2*x,self.h]
-			self.drawcv.surface.set_clip(updaterect)
-			self.drawcv.surface.blit(self.cv.surface,(0,0))
-		# bottom half
-		for y in range(0,int((self.r+1)/self.h)):
-			x = (self.r**2-y**2)**0.5
-			updaterect = [frlpos[0]-x,frlpos[1]+self.h*y,2*x,self.h]
-			self.drawcv.surface.set_clip(updaterect)
-			self.drawcv.surface.blit(self.cv.surface,(0,0))
-		
-		# unset clip and show canvas
-		self.drawcv.surface.set_clip(None)
-		self.drawcv.show()
+		
+		# copy the aperture's bounding box from the sketchpad, and cover
+		# everything outside of the aperture with the (cached) overlay
+		self.drawcv.surface.blit(self.cv.surface, self.frlrect, self.frlrect)
+		self.drawcv.surface.blit(self.overlay, self.frlrect)
+		
+		# show canvas
+		self.tdrawend = self.time()
+		return self.drawcv.show()
+	
+	def dirtyupdate(self, gazepos):
+		
+		"""update frl using PyGame, redrawing only the areas that changed;
+		for internal use"""
+		
+		# the first frame has nothing on the display to build on
+		if self.prevrect is None:
+			tflip = self.pygameupdate(gazepos)
+			self.prevrect = self.frlrect.copy()
+			return tflip
+		
+		# frl position
+		frlpos = (gazepos[0]-self.frlcor[0], gazepos[1]-self.frlcor[1])
+		self.frlrect.center = (int(frlpos[0]), int(frlpos[1]))
+		
+		# erase the previous aperture, and draw the new one
+		self.drawcv.surface.fill(self.drawcv.bgcolor, self.prevrect)
+		self.drawcv.surface.blit(self.cv.surface, self.frlrect, self.frlrect)
+		self.drawcv.surface.blit(self.overlay, self.frlrect)
+		
+		# copy the changed areas to the display, and update only those
+		rects = libfrl.dirty_rects(self.prevrect, self.frlrect, \
+			self.drawcv.surface.get_rect())
+		for rect in rects:
+			self.experiment.surface.blit(self.drawcv.surface, rect, rect)
+		self.tdrawend = self.time()
+		pygame.display.update(rects)
+		self.prevrect = self.frlrect.copy()
+		
+		return self.time()
 		
 	
 	def psychoupdate(self, gazepos):
@@ -225,9 +356,21 @@ class frl(item.item):
 		frlpos = (gazepos[0]-self.frlcor[0], gazepos[1]+self.frlcor[1])
 		# apply frl
 		self.frl.setPos(frlpos)
-		self.frl.enable()
-		self.cv.show()
-		self.frl.disable()
+		# with a pre-rendered sketchpad, the Aperture stays enabled during
+		# the whole trial (see run)
+		if self.texture == None:
+			self.frl.enable()
+		for stim in self.stimuli:
+			stim.draw()
+		if self.softedge != None:
+			self.softedge.setPos(frlpos)
+			self.softedge.draw()
+		self.tdrawend = self.time()
+		self.experiment.window.flip(clearBuffer=True)
+		if self.texture == None:
+			self.frl.disable()
+		
+		return self.time()
 		
 	
 	def run(self):
@@ -244,12 +387,73 @@ class frl(item.item):
 		stop = False
 		t0 = self.time()
 		
+		# frame skipping: the display is only redrawn when gaze moves by
+		# more than the threshold, or when it has not been redrawn for
+		# maxstale milliseconds
+		threshold = self.get(u'threshold')
+		maxstale = self.get(u'maxstale')
+		drawnpos = None
+		tdrawn = t0
+		self.rendered = 0
+		self.skipped = 0
+		
+		# gaze samples are either read from the eye tracker directly, or
+		# from a sampler that polls the eye tracker on its own thread
+		if self.get(u'sampling') == u'background thread':
+			sampler = libfrl.gazesampler(self.experiment.eyetracker, self.time)
+			sampler.start()
+		else:
+			sampler = None
+		nsamples = 0
+		chunks = []
+		
+		# frame timing
+		self.frametimer = libfrl.frametimer()
+		consecutive = False
+		
+		# a persistent Aperture for the pre-rendered sketchpad
+		persistent = self.get("canvas_backend") == u'psycho' and \
+			self.texture != None
+		if persistent:
+			self.frl.enable()
+		
 		while not stop:
 			# get gaze position
-			gazepos = self.experiment.eyetracker.sample()
+			if sampler == None:
+				gazepos = self.experiment.eyetracker.sample()
+				tsample = self.time()
+				chunk = [(tsample, gazepos[0], gazepos[1])]
+				if self.store != None:
+					chunks.append(chunk)
+			else:
+				# collect the full sample stream, and use the newest sample
+				chunk, nsamples = sampler.samples(nsamples)
+				if len(chunk) > 0:
+					chunks.append(chunk)
+					tsample, gazepos = chunk[-1,0], (chunk[-1,1], chunk[-1,2])
+			
+			# predict where gaze will be by the time the frame is shown;
+			# the raw position is used when tracking is lost
+			if self.predictor != None:
+				self.predictor.update(chunk)
+				predicted = self.predictor.predict()
+				if predicted != None:
+					gazepos = predicted
 			
 			# update frl accordingly
-			self.updatefunc(gazepos)
+			if drawnpos == None or self.time() - tdrawn >= maxstale or \
+				math.hypot(gazepos[0]-drawnpos[0], gazepos[1]-drawnpos[1]) > threshold:
+				tdrawstart = self.time()
+				tflip = self.updatefunc(gazepos)
+				self.frametimer.record(tsample, tdrawstart, self.tdrawend, \
+					tflip, consecutive)
+				consecutive = True
+				drawnpos = gazepos
+				tdrawn = tflip
+				self.rendered += 1
+			else:
+				consecutive = False
+				self.skipped += 1
 			
 			# response
 			response, t1 = self.kb.get_key()
@@ -258,8 +462,50 @@ class frl(item.item):
 			if (self.time() - t0 > self.timeout and not self.notimeout) or (response != None):
 				stop = True
 		
+		if persistent:
+			self.frl.disable()
+		
+		# all samples of this trial, as (timestamp, x, y) rows; inline
+		# sampling only keeps them (one per frame) for the column store
+		if sampler != None:
+			sampler.stop()
+			chunks.append(sampler.samples(nsamples)[0])
+		if len(chunks) == 0:
+			self.samples = None
+		else:
+			self.samples = numpy.concatenate(chunks)
+		
 		self.experiment.set(u'response', response)
 		self.experiment.set(u'response_time', t1-t0)
+		self.experiment.set(u'frl_frames_rendered', self.rendered)
+		self.experiment.set(u'frl_frames_skipped', self.skipped)
+		
+		# latency between gaze sample and display flip
+		p50, p95, p99 = self.frametimer.latency()
+		self.experiment.set(u'frl_latency_p50', p50)
+		self.experiment.set(u'frl_latency_p95', p95)
+		self.experiment.set(u'frl_latency_p99', p99)
+		self.experiment.set(u'frl_dropped_frames', self.frametimer.dropped())
+		if self.get(u'latencylog') == u'yes':
+			path = os.path.splitext(self.experiment.logfile)[0] + \
+				u'_%s_frames.bin' % self.name
+			# like the logfile, the file is written anew for every session,
+			# rather than appended to the frames of an earlier session
+			if not hasattr(self.experiment, u'frlframelogs'):
+				self.experiment.frlframelogs = set()
+			if path not in self.experiment.frlframelogs:
+				if os.path.exists(path):
+					os.remove(path)
+				self.experiment.frlframelogs.add(path)
+			self.frametimer.save(path, \
+				self.experiment.get(u'count_%s' % self.name))
+		
+		# only the trial's key is logged for the samples in the column store
+		if self.store != None:
+			key = self.experiment.get(u'count_%s' % self.name)
+			self.store.append(key, {u't': self.samples[:,0], \
+				u'x': self.samples[:,1], u'y': self.samples[:,2]})
+			self.experiment.set(u'frl_store_trial', key)
 		
 		return True
 		
@@ -304,8 +550,38 @@ class qtfrl(frl, qtplugin.qtplugin):
 			'FRL angle', 0, 360, suffix=' degrees', tooltip= \
 			'The deviation from a horizontal line (0 is a position to the left of the gaze position; 90 to the top; 180 to the right)')
 		self.add_combobox_control("frltype", "FRL type", \
-			['circle'], \
+			['circle', 'gauss', 'raised cosine'], \
 			tooltip = "Indicates the FRL type")
+		self.add_spinbox_control('sigma', \
+			'FRL edge', 0, 1000, suffix=' px', tooltip= \
+			'The standard deviation of a gauss FRL, or the width of the edge of a raised cosine FRL')
+		self.add_combobox_control("redraw", "Redraw", \
+			['full screen', 'dirty rectangles'], \
+			tooltip = "Redraw the full screen on every frame, or only the areas around the old and new FRL position (legacy backend without double buffering or hardware surfaces only)")
+		self.add_spinbox_control('threshold', \
+			'Redraw threshold', 0, 2000, suffix=' px', tooltip= \
+			'The display is not redrawn while gaze moves less than this distance (0 only skips frames when gaze did not move at all)')
+		self.add_spinbox_control('maxstale', \
+			'Maximal staleness', 0, 100000, suffix=' ms', tooltip= \
+			'The display is always redrawn when it has not been redrawn for this long')
+		self.add_combobox_control("sampling", "Gaze sampling", \
+			['inline', 'background thread'], \
+			tooltip = "Sample gaze once per frame, or continuously on a separate thread (keeps all samples, and the newest sample is used for every frame)")
+		self.add_combobox_control("latencylog", "Log frame timing", \
+			['no', 'yes'], \
+			tooltip = "Append the sample, drawing and flip times of every frame to a binary file next to the logfile")
+		self.add_combobox_control("prediction", "Gaze prediction", \
+			['none', 'linear', 'kalman'], \
+			tooltip = "Place the FRL where gaze is expected to be when the display is updated, using linear extrapolation or a constant-velocity Kalman filter")
+		self.add_spinbox_control('horizon', \
+			'Prediction horizon', 0, 1000, suffix=' ms', tooltip= \
+			'How far ahead of the newest sample gaze is predicted; this should match the delay between sampling and the display flip')
+		self.add_combobox_control("prerender", "Pre-render sketchpad", \
+			['no', 'yes'], \
+			tooltip = "Flatten the sketchpad into a single texture before the trial starts, so that drawing costs the same regardless of the number of sketchpad elements (psycho backend only)")
+		self.add_combobox_control("outputmode", "Output", \
+			['variables', 'column store'], \
+			tooltip = "Only log the frame counts and latencies as variables, or also append the trial's gaze samples to a column store next to the logfile, and log the trial's key (frl_store_trial)")
 		
 		# credits
 		self.add_text("<br><br><small><b>Copyrights Edwin S. Dalmaijer, 2013. Based on PyGaze toolbox: http://www.fss.uu.nl/psn/pygaze/</b></small>")
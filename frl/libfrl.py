@@ -0,0 +1,882 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import io
+import math
+import time
+import collections
+import threading
+import numpy
+import pygame
+
+# Note that the AOI and FRL plug-ins are installed separately, so that both
+# carry their own copy of the gaze sampler, the canvas cache, and the column
+# store; the plug-ins keep their instances under their own experiment
+# attributes (e.g. experiment.aoicanvascache and experiment.frlcanvascache),
+# so that one plug-in never uses the other's copy.
+
+# FRL types that the aperture functions below know how to build
+FRLTYPES = [u'circle', u'gauss', u'raised cosine']
+
+# gaze prediction methods (see gazepredictor)
+PREDICTORS = [u'none', u'linear', u'kalman']
+
+# alpha profiles and overlays are built once, and then reused by every FRL
+# item and trial
+_alphacache = {}
+_overlaycache = {}
+
+
+def aperture_alpha(size, frltype, sigma=None):
+
+	"""Returns the alpha profile of an FRL aperture
+
+	arguments
+	size		--	FRL diameter in pixels
+	frltype	--	FRL type (see FRLTYPES)
+
+	keyword arguments
+	sigma		--	edge softness in pixels: the standard deviation for
+				u'gauss', or the width of the edge for u'raised
+				cosine'; ignored for u'circle' (default = None)
+
+	returns
+	alpha		--	a read-only size x size numpy array, with values
+				between 0 (invisible) and 1 (fully visible); the
+				profile is radially symmetric, so it can be used as
+				both an (x,y) and a (row,column) array
+	"""
+
+	if frltype == u'circle':
+		sigma = None
+	key = (size, frltype, sigma)
+	if key in _alphacache:
+		return _alphacache[key]
+
+	if frltype not in FRLTYPES:
+		raise ValueError(u"unknown FRL type '%s'" % frltype)
+	if sigma != None and sigma <= 0:
+		raise ValueError(u"the FRL edge should be larger than 0")
+
+	# distance of every pixel centre to the aperture centre
+	r = size / 2.0
+	c = numpy.arange(size) + 0.5 - r
+	d = numpy.hypot(c[:,numpy.newaxis], c[numpy.newaxis,:])
+
+	if frltype == u'circle':
+		alpha = numpy.ones((size,size))
+	elif frltype == u'gauss':
+		alpha = numpy.exp(-d**2 / (2.0*sigma**2))
+	elif frltype == u'raised cosine':
+		edge = min(float(sigma), r)
+		alpha = numpy.ones((size,size))
+		ramp = d > r - edge
+		alpha[ramp] = 0.5 * (1 + numpy.cos(math.pi * \
+			(d[ramp] - (r - edge)) / edge))
+	alpha[d > r] = 0
+
+	alpha.flags.writeable = False
+	_alphacache[key] = alpha
+
+	return alpha
+
+
+def aperture_overlay(size, frltype, color, sigma=None):
+
+	"""Returns a surface that covers everything but the FRL aperture
+
+	arguments
+	size		--	FRL diameter in pixels
+	frltype	--	FRL type (see FRLTYPES)
+	color		--	colour of the area around the aperture; this should
+				be the background colour of the canvas the overlay is
+				drawn on
+
+	keyword arguments
+	sigma		--	edge softness in pixels (see aperture_alpha;
+				default = None)
+
+	returns
+	overlay	--	a size x size pygame.Surface with per-pixel alpha,
+				which is transparent within the aperture and opaque
+				(in the specified colour) outside of it
+	"""
+
+	if frltype == u'circle':
+		sigma = None
+	color = tuple(color)[:3]
+	key = (size, frltype, sigma, color)
+	if key in _overlaycache:
+		return _overlaycache[key]
+
+	alpha = aperture_alpha(size, frltype, sigma)
+	overlay = pygame.Surface((size,size), pygame.SRCALPHA)
+	overlay.fill(color + (255,))
+	pixels = pygame.surfarray.pixels_alpha(overlay)
+	pixels[:] = numpy.round(255 * (1 - alpha)).astype(numpy.uint8)
+	# the surface remains locked for as long as the pixel array exists
+	del pixels
+
+	_overlaycache[key] = overlay
+
+	return overlay
+
+
+def aperture_mask(size, frltype, sigma=None):
+
+	"""Returns a PsychoPy mask for a stimulus that covers everything but the
+	FRL aperture
+
+	arguments
+	size		--	FRL diameter in pixels
+	frltype	--	FRL type (see FRLTYPES)
+
+	keyword arguments
+	sigma		--	edge softness in pixels (see aperture_alpha;
+				default = None)
+
+	returns
+	mask		--	a square numpy array with values between -1
+				(transparent) and 1 (opaque); the array is padded to
+				a power of two, as PsychoPy requires, so the stimulus
+				should be mask.shape[0] pixels wide
+	"""
+
+	alpha = aperture_alpha(size, frltype, sigma)
+	n = 2**int(math.ceil(math.log(max(size,1), 2)))
+	pad = (n - size) // 2
+	mask = numpy.zeros((n,n))
+	mask[pad:pad+size,pad:pad+size] = alpha
+
+	return 1 - 2*mask
+
+
+def dirty_rects(oldrect, newrect, bounds):
+
+	"""Returns the display areas that need updating when the aperture
+	moves from one position to another
+
+	arguments
+	oldrect	--	the aperture's previous bounding box (a pygame.Rect)
+	newrect	--	the aperture's new bounding box (a pygame.Rect)
+	bounds	--	a pygame.Rect of the display
+
+	returns
+	rects		--	a list of pygame.Rects, clipped to the display; this
+				is the union of both boxes when they overlap, or both
+				boxes separately when they do not
+	"""
+
+	if oldrect.colliderect(newrect):
+		rects = [oldrect.union(newrect)]
+	else:
+		rects = [oldrect, newrect]
+
+	return [rect.clip(bounds) for rect in rects]
+
+
+class gazesampler(object):
+
+	"""Polls an eye tracker on a background thread, and keeps the samples in
+	a fixed-size ring buffer"""
+
+	def __init__(self, eyetracker, clock, capacity=8192, interval=0.001, \
+		callback=None):
+
+		"""
+		Constructor
+
+		Arguments:
+		eyetracker	--	an object with a sample() method that returns the
+					current (x,y) gaze position
+		clock		--	a function that returns the current time in
+					milliseconds
+
+		Keyword arguments:
+		capacity	--	the number of samples in the buffer; older
+					samples are overwritten (default=8192)
+		interval	--	the pause between two polls in seconds
+					(default=0.001)
+		callback	--	a function that is called with the timestamp, x,
+					and y of every new sample, on the sampling thread,
+					or None (default=None)
+		"""
+
+		self.eyetracker = eyetracker
+		self.clock = clock
+		self.capacity = capacity
+		self.interval = interval
+		self.callback = callback
+		# one (timestamp, x, y) row per sample; self.count is only
+		# increased after a row has been written, so that readers never
+		# need a lock to see complete samples
+		self.buffer = numpy.zeros((capacity,3))
+		self.count = 0
+		self.error = None
+		self._running = False
+		self._started = threading.Event()
+		self._thread = None
+
+	def start(self):
+
+		"""Starts sampling, and returns once the first sample is in"""
+
+		self.count = 0
+		self.error = None
+		self._running = True
+		self._started.clear()
+		self._thread = threading.Thread(target=self._poll)
+		self._thread.daemon = True
+		self._thread.start()
+		self._started.wait()
+		if self.error != None:
+			raise self.error
+
+	def stop(self):
+
+		"""Stops sampling"""
+
+		self._running = False
+		if self._thread != None:
+			self._thread.join()
+			self._thread = None
+		if self.error != None:
+			raise self.error
+
+	def newest(self):
+
+		"""
+		Returns the newest sample
+
+		Returns:
+		A (timestamp, (x,y)) tuple, or None when there are no samples yet
+		"""
+
+		n = self.count
+		if n == 0:
+			return None
+		t, x, y = self.buffer[(n-1) % self.capacity]
+
+		return t, (x, y)
+
+	def samples(self, since=0):
+
+		"""
+		Returns the samples that came in after a specific sample
+
+		Keyword arguments:
+		since		--	the number of samples that have already been
+					read, as returned by a previous call (default=0)
+
+		Returns:
+		A (samples, count) tuple, where samples is an n x 3 array of
+		(timestamp, x, y) rows, and count should be passed to the next
+		call. Samples that have been overwritten before they could be
+		read are skipped.
+		"""
+
+		n = self.count
+		# the oldest row may be overwritten while it is copied
+		first = max(since, n - self.capacity + 1)
+		i = numpy.arange(first, n) % self.capacity
+
+		return self.buffer[i], n
+
+	def _poll(self):
+
+		"""Fills the buffer; runs on the sampling thread"""
+
+		try:
+			while self._running:
+				x, y = self.eyetracker.sample()
+				t = self.clock()
+				self.buffer[self.count % self.capacity] = (t, x, y)
+				self.count += 1
+				if self.callback != None:
+					self.callback(t, x, y)
+				self._started.set()
+				time.sleep(self.interval)
+		# errors are raised again by start() or stop()
+		except Exception as e:
+			self.error = e
+			self._running = False
+			self._started.set()
+
+
+class frametimer(object):
+
+	"""Keeps the timestamps of every frame, to determine how old the gaze
+	sample that a frame is based on is by the time the frame is shown"""
+
+	# the columns of the timestamp array, and of the binary file
+	COLUMNS = [u'sample', u'drawstart', u'drawend', u'flip', u'consecutive']
+
+	def __init__(self, capacity=4096):
+
+		"""
+		Constructor
+
+		Keyword arguments:
+		capacity	--	the number of frames to allocate room for; the
+					array doubles in size when it is full
+					(default=4096)
+		"""
+
+		self.times = numpy.zeros((capacity,len(self.COLUMNS)))
+		self.count = 0
+
+	def record(self, tsample, tdrawstart, tdrawend, tflip, consecutive):
+
+		"""
+		Stores the timestamps of a frame
+
+		Arguments:
+		tsample	--	the time at which the gaze sample was acquired
+		tdrawstart	--	the time at which drawing started
+		tdrawend	--	the time at which drawing ended
+		tflip		--	the time at which the display flip returned
+		consecutive	--	True if the previous loop iteration rendered a
+					frame too, i.e. if no frames were skipped in
+					between
+		"""
+
+		if self.count == len(self.times):
+			self.times = numpy.concatenate((self.times, \
+				numpy.zeros(self.times.shape)))
+		self.times[self.count] = (tsample, tdrawstart, tdrawend, tflip, \
+			consecutive)
+		self.count += 1
+
+	def latency(self, percentiles=(50,95,99)):
+
+		"""
+		Returns percentiles of the sample-to-flip latency
+
+		Keyword arguments:
+		percentiles	--	the percentiles to compute (default=(50,95,99))
+
+		Returns:
+		A list of latencies in milliseconds, or a list of Nones when no
+		frames have been recorded
+		"""
+
+		if self.count == 0:
+			return [None] * len(percentiles)
+		t = self.times[:self.count]
+
+		return [float(p) for p in numpy.percentile(t[:,3]-t[:,0], percentiles)]
+
+	def dropped(self, tolerance=1.5):
+
+		"""
+		Returns the number of dropped frames, i.e. the number of flips that
+		followed the previous flip later than tolerance times the median
+		flip interval; intervals that include skipped frames are ignored
+
+		Keyword arguments:
+		tolerance	--	the maximal interval, relative to the median
+					interval (default=1.5)
+
+		Returns:
+		The number of dropped frames
+		"""
+
+		t = self.times[:self.count]
+		intervals = numpy.diff(t[:,3])[t[1:,4] > 0]
+		if len(intervals) == 0:
+			return 0
+
+		return int(numpy.sum(intervals > tolerance*numpy.median(intervals)))
+
+	def save(self, path, trial):
+
+		"""
+		Appends the timestamps to a binary file of little-endian float64
+		values, with one row per frame: the trial number, followed by the
+		COLUMNS; numpy.fromfile(path, '<f8').reshape(-1,6) reads it back
+
+		Arguments:
+		path		--	the path to the file
+		trial		--	the trial number
+		"""
+
+		rows = numpy.column_stack((numpy.repeat(float(trial), self.count), \
+			self.times[:self.count]))
+		f = open(path, u'ab')
+		rows.astype(u'<f8').tofile(f)
+		f.close()
+
+
+def validsample(x, y):
+
+	"""Returns False for samples that signal lost tracking, i.e. samples
+	with coordinates that are not finite, and the (0,0) and (-1,-1)
+	positions that trackers report when they lose the eyes
+
+	arguments
+	x		--	x coordinate
+	y		--	y coordinate
+
+	returns
+	valid		--	True or False
+	"""
+
+	return bool(numpy.isfinite(x) and numpy.isfinite(y) and \
+		(x > 0 or y > 0))
+
+
+class gazepredictor(object):
+
+	"""Estimates where gaze will be a short while after the newest sample,
+	to compensate for the delay between sampling and the display flip"""
+
+	def __init__(self, method, horizon, window=20, bounds=None, \
+		noise=25.0, acceleration=1.0):
+
+		"""
+		Constructor
+
+		Arguments:
+		method		--	u'linear' for linear extrapolation of the
+						velocity in the recent samples, or u'kalman'
+						for a constant-velocity Kalman filter
+		horizon		--	the prediction horizon in milliseconds
+
+		Keyword arguments:
+		window			--	the sample history in milliseconds: the
+						linear fit uses the samples within this window,
+						and a gap between samples that is longer than
+						the window resets the prediction (default=20)
+		bounds			--	a (width,height) tuple; predictions are
+						clipped to this area (default=None)
+		noise			--	the Kalman filter's measurement noise
+						variance in px^2 (default=25.0)
+		acceleration	--	the Kalman filter's process noise, as the
+						variance of the acceleration in (px/ms^2)^2
+						(default=1.0)
+		"""
+
+		if method not in PREDICTORS[1:]:
+			raise ValueError(u"unknown prediction method '%s'" % method)
+		self.method = method
+		self.horizon = horizon
+		self.window = window
+		self.bounds = bounds
+		self.noise = noise
+		self.acceleration = acceleration
+		self.reset()
+
+	def reset(self):
+
+		"""Forgets the sample history, e.g. after tracking was lost"""
+
+		# linear: the newest samples, as (timestamp, x, y) rows
+		self.history = numpy.zeros((0,3))
+		# kalman: per axis a (position, velocity) state and covariance
+		self.state = None
+		self.cov = None
+		self.t = None
+
+	def update(self, samples):
+
+		"""
+		Adds samples to the history
+
+		Arguments:
+		samples	--	an n x 3 array of (timestamp, x, y) rows, in
+					chronological order
+		"""
+
+		for t, x, y in samples:
+			if not validsample(x, y) or \
+				(self.t != None and t - self.t > self.window):
+				self.reset()
+				if not validsample(x, y):
+					continue
+			if self.method == u'linear':
+				self._linear(t, x, y)
+			else:
+				self._kalman(t, x, y)
+			self.t = t
+			self.pos = (x, y)
+
+	def predict(self):
+
+		"""
+		Returns the predicted gaze position
+
+		Returns:
+		An (x,y) tuple with the position at the newest sample's timestamp
+		plus the horizon, the newest raw position if there is not enough
+		history for a prediction, or None if there is no valid sample
+		"""
+
+		if self.t == None:
+			return None
+
+		if self.method == u'linear':
+			if len(self.history) < 2 or numpy.ptp(self.history[:,0]) == 0:
+				return self.pos
+			# least-squares velocity over the window
+			t = self.history[:,0] - self.history[:,0].mean()
+			v = numpy.dot(t, self.history[:,1:] - \
+				self.history[:,1:].mean(axis=0)) / numpy.dot(t, t)
+			x, y = self.pos + v*self.horizon
+		else:
+			x, y = self.state[0] + self.state[1]*self.horizon
+
+		if self.bounds != None:
+			x = min(max(x, 0), self.bounds[0])
+			y = min(max(y, 0), self.bounds[1])
+
+		return x, y
+
+	def _linear(self, t, x, y):
+
+		"""Adds a sample to the linear history; for internal use"""
+
+		self.history = numpy.vstack((self.history, (t, x, y)))
+		self.history = self.history[self.history[:,0] >= t - self.window]
+
+	def _kalman(self, t, x, y):
+
+		"""Runs one Kalman filter step; for internal use"""
+
+		z = numpy.array((x, y))
+		if self.state is None:
+			# position: the first sample; velocity: unknown
+			self.state = numpy.vstack((z, numpy.zeros(2)))
+			self.cov = numpy.array([[self.noise, 0.0], [0.0, 1.0]])
+			return
+
+		# predict; both axes share the (position, velocity) covariance
+		dt = t - self.t
+		f = numpy.array([[1.0, dt], [0.0, 1.0]])
+		q = self.acceleration * numpy.array([[dt**4/4.0, dt**3/2.0], \
+			[dt**3/2.0, dt**2]])
+		self.state = numpy.dot(f, self.state)
+		self.cov = numpy.dot(numpy.dot(f, self.cov), f.T) + q
+
+		# correct
+		k = self.cov[:,0] / (self.cov[0,0] + self.noise)
+		self.state = self.state + numpy.outer(k, z - self.state[0])
+		self.cov = self.cov - numpy.outer(k, self.cov[0])
+
+
+class canvascache(object):
+
+	"""A least-recently-used cache of prepared canvases (or other objects
+	that are derived from a sketchpad), which is shared by all items of an
+	experiment"""
+
+	def __init__(self, budget):
+
+		"""
+		Constructor
+
+		Arguments:
+		budget		--	the memory budget in bytes; the least recently
+					used entries are dropped when it is exceeded
+		"""
+
+		self.budget = budget
+		self.size = 0
+		self._entries = collections.OrderedDict()
+
+	def get(self, key, source):
+
+		"""
+		Returns a cached object
+
+		Arguments:
+		key		--	the entry's key, e.g. a (kind, sketchpad name) tuple
+		source		--	the sketchpad canvas that the object should have
+					been prepared from; a sketchpad gets a new canvas
+					whenever it is prepared, so entries that were
+					prepared from a different canvas are out of date
+
+		Returns:
+		The cached object, or None if there is no up-to-date entry
+		"""
+
+		entry = self._entries.pop(key, None)
+		if entry == None:
+			return None
+		if entry[0] is not source:
+			self.size -= entry[2]
+			return None
+		# re-inserting marks the entry as the most recently used one
+		self._entries[key] = entry
+
+		return entry[1]
+
+	def put(self, key, source, obj, nbytes):
+
+		"""
+		Adds an object to the cache
+
+		Arguments:
+		key		--	the entry's key
+		source		--	the sketchpad canvas the object was prepared from;
+					the entry keeps a reference to it, so that it
+					cannot be confused with a later canvas
+		obj		--	the object to cache
+		nbytes		--	the (estimated) memory use of the object
+		"""
+
+		if key in self._entries:
+			self.size -= self._entries.pop(key)[2]
+		self._entries[key] = (source, obj, nbytes)
+		self.size += nbytes
+		while self.size > self.budget and len(self._entries) > 1:
+			oldkey, entry = self._entries.popitem(last=False)
+			self.size -= entry[2]
+
+
+class columnstore(object):
+
+	"""An append-only store of per-trial data, for output that is too large
+	to be logged as variables: every column is a binary file of
+	little-endian values in the store's directory, and index.txt lists the
+	rows of every trial, so that trials can be read back lazily, from
+	memory maps, without loading the rest of the store; string columns are
+	stored as numbers that index a table of the column's strings"""
+
+	def __init__(self, path, new=False):
+
+		"""
+		Constructor; opens a store, or creates it if it does not exist
+
+		Arguments:
+		path		--	the path to the store's directory
+
+		Keyword arguments:
+		new		--	True empties an existing store, e.g. when the
+					logfile that it belongs to is written anew
+					(default=False)
+		"""
+
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		if new:
+			for name in os.listdir(path):
+				if name.endswith(u'.txt') or name.endswith(u'.bin'):
+					os.remove(self._file(name))
+		# column names and types, in the order of columns.txt
+		self.columns = collections.OrderedDict()
+		# the strings of string columns, and their numbers
+		self.strings = {}
+		self._codes = {}
+		# (first row, number of rows) tuples, keyed by trial key
+		self.index = collections.OrderedDict()
+		self.rows = 0
+		self._maps = {}
+		if os.path.exists(self._file(u'columns.txt')):
+			f = io.open(self._file(u'columns.txt'), encoding=u'utf-8')
+			for line in f:
+				name, dtype = line.rstrip(u'\n').split(u'\t')
+				if dtype == u'str':
+					self._addstrings(name)
+				else:
+					self.columns[name] = numpy.dtype(str(dtype))
+			f.close()
+		if os.path.exists(self._file(u'index.txt')):
+			f = io.open(self._file(u'index.txt'), encoding=u'utf-8')
+			for line in f:
+				key, first, count = line.rstrip(u'\n').split(u'\t')
+				self.index[key] = int(first), int(count)
+				self.rows = int(first) + int(count)
+			f.close()
+		# a trial is only indexed once all of its columns are written, so
+		# rows beyond the index are from an interrupted append; they are
+		# dropped to keep the columns aligned
+		for name, dtype in self.columns.items():
+			path = self._file(name + u'.bin')
+			if os.path.exists(path) and \
+				os.path.getsize(path) > self.rows * dtype.itemsize:
+				f = open(path, u'r+b')
+				f.truncate(self.rows * dtype.itemsize)
+				f.close()
+
+	def _file(self, name):
+
+		"""Returns the path to a file in the store's directory"""
+
+		return os.path.join(self.path, name)
+
+	def _addstrings(self, name):
+
+		"""Adds a string column, with the strings in its table; for
+		internal use"""
+
+		self.columns[name] = numpy.dtype(u'<i4')
+		self.strings[name] = []
+		self._codes[name] = {}
+		if os.path.exists(self._file(name + u'.txt')):
+			f = io.open(self._file(name + u'.txt'), encoding=u'utf-8')
+			for line in f:
+				self._codes[name][line.rstrip(u'\n')] = \
+					len(self.strings[name])
+				self.strings[name].append(line.rstrip(u'\n'))
+			f.close()
+
+	def _encode(self, name, values):
+
+		"""Returns the numbers of the strings in a string column, and adds
+		new strings to its table; for internal use"""
+
+		values = [value.decode(u'utf-8') if isinstance(value, bytes) else \
+			u'%s' % value for value in values]
+		codes = self._codes[name]
+		new = []
+		for value in values:
+			if value not in codes:
+				if u'\n' in value:
+					raise ValueError( \
+						u'the strings in a column store cannot contain newlines')
+				codes[value] = len(self.strings[name])
+				self.strings[name].append(value)
+				new.append(value)
+		if len(new) > 0:
+			f = io.open(self._file(name + u'.txt'), u'a', encoding=u'utf-8')
+			for value in new:
+				f.write(value + u'\n')
+			f.close()
+
+		return numpy.array([codes[value] for value in values], dtype=u'<i4')
+
+	def _decode(self, name, codes):
+
+		"""Returns the values of a column, with the numbers of a string
+		column replaced by their strings; for internal use"""
+
+		if name not in self.strings:
+			return codes
+
+		# the extra string makes the table a string array when it is empty
+		return numpy.array(self.strings[name] + [u''])[codes]
+
+	def append(self, key, columns):
+
+		"""
+		Appends the rows of a trial
+
+		Arguments:
+		key		--	the trial's key, e.g. its trial number, which
+					should be unique within the store
+		columns		--	a dict of equally long 1-D arrays (or lists),
+					keyed by column name; the first trial sets the
+					columns and their types, and later trials need to
+					have the same columns
+		"""
+
+		key = u'%s' % key
+		if key in self.index:
+			raise ValueError(u'trial %s is already in the store' % key)
+		arrays = {}
+		for name, values in columns.items():
+			arrays[name] = numpy.asarray(values)
+		counts = set(len(values) for values in arrays.values())
+		if len(counts) > 1:
+			raise ValueError(u'the columns of trial %s differ in length' % \
+				key)
+		if len(self.columns) == 0:
+			f = io.open(self._file(u'columns.txt'), u'a', encoding=u'utf-8')
+			for name in sorted(arrays):
+				if arrays[name].dtype.kind in u'SU':
+					f.write(u'%s\tstr\n' % name)
+					self._addstrings(name)
+				else:
+					dtype = arrays[name].dtype.newbyteorder(u'<')
+					f.write(u'%s\t%s\n' % (name, dtype.str))
+					self.columns[name] = dtype
+			f.close()
+		elif set(arrays) != set(self.columns):
+			raise ValueError(u'the columns of trial %s (%s) are not those of the store (%s)' \
+				% (key, u', '.join(sorted(arrays)), \
+				u', '.join(self.columns)))
+		count = counts.pop()
+
+		for name, dtype in self.columns.items():
+			if name in self.strings:
+				values = self._encode(name, arrays[name])
+			else:
+				values = arrays[name].astype(dtype)
+			f = open(self._file(name + u'.bin'), u'ab')
+			values.tofile(f)
+			f.close()
+		f = io.open(self._file(u'index.txt'), u'a', encoding=u'utf-8')
+		f.write(u'%s\t%d\t%d\n' % (key, self.rows, count))
+		f.close()
+		self.index[key] = self.rows, count
+		self.rows += count
+		self._maps = {}
+
+	def keys(self):
+
+		"""Returns the keys of all trials, in the order they were stored"""
+
+		return list(self.index.keys())
+
+	def column(self, name):
+
+		"""
+		Returns a whole column
+
+		Arguments:
+		name		--	the column name
+
+		Returns:
+		A read-only memory map of the column's values, or an array of
+		strings for a string column
+		"""
+
+		return self._decode(name, self._map(name))
+
+	def _map(self, name):
+
+		"""Returns a memory map of a column's file; for internal use"""
+
+		if name not in self._maps:
+			if self.rows == 0:
+				# empty files cannot be memory mapped
+				self._maps[name] = numpy.zeros(0, self.columns[name])
+			else:
+				self._maps[name] = numpy.memmap(self._file(name + u'.bin'), \
+					dtype=self.columns[name], mode=u'r', shape=(self.rows,))
+
+		return self._maps[name]
+
+	def trial(self, key):
+
+		"""
+		Returns the rows of a trial
+
+		Arguments:
+		key		--	the trial's key
+
+		Returns:
+		A dict of 1-D arrays (views of memory maps, or arrays of strings),
+		keyed by column name
+		"""
+
+		first, count = self.index[u'%s' % key]
+
+		return dict((name, self._decode(name, \
+			self._map(name)[first:first+count])) for name in self.columns)
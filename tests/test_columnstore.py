@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Regression tests for the built-in fixation detectors: a fixed gaze signal
+# is detected in one go, and in chunks of several sizes, which should give
+# the same fixations.
+#
+#	python -m unittest discover tests
+# Round-trip tests for the column stores of both plug-ins, which carry
+# their own copies of the store.
+#
+#	python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for plugin in ['frl', 'aoi']:
+	sys.path.insert(0, os.path.join(ROOT, plugin))
+import libaoi
+try:
+	import libfrl
+except ImportError:
+	# libfrl needs PyGame
+	libfrl = None
+
+
+class columnstoretest(unittest.TestCase):
+
+	"""Tests libaoi.columnstore"""
+
+	lib = libaoi
+
+	def setUp(self):
+
+		self.tmp = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmp, u'subject0_aoi_store')
+
+	def tearDown(self):
+
+		shutil.rmtree(self.tmp)
+
+	def trials(self):
+
+		"""Returns the rows of two trials, with numbers, strings, and an
+		empty trial in between"""
+
+		return [
+			(3, {u'aoi': [u'face', u'left', u'notAOI'], \
+				u'dwell': [120.5, 0., numpy.nan], \
+				u'fixcount': numpy.array([2, 0, 1])}),
+			(4, {u'aoi': numpy.array([], dtype=u'U1'), \
+				u'dwell': numpy.zeros(0), \
+				u'fixcount': numpy.zeros(0, dtype=int)}),
+			(u'5', {u'aoi': [u'a much longer name', u'été', \
+				u'face'], u'dwell': [1., 2., 3.], \
+				u'fixcount': [7, 8, 9]}),
+			]
+
+	def assertTrial(self, rows, expected):
+
+		"""Checks the rows of a trial"""
+
+		self.assertEqual(sorted(rows), sorted(expected))
+		self.assertEqual(list(rows[u'aoi']), list(expected[u'aoi']))
+		numpy.testing.assert_array_equal(rows[u'dwell'], expected[u'dwell'])
+		numpy.testing.assert_array_equal(rows[u'fixcount'], \
+			expected[u'fixcount'])
+
+	def test_roundtrip(self):
+
+		"""Trials read back as they were appended, also after reopening
+		the store"""
+
+		store = self.lib.columnstore(self.path)
+		for key, columns in self.trials():
+			store.append(key, columns)
+		for store in [store, self.lib.columnstore(self.path)]:
+			self.assertEqual(store.keys(), [u'3', u'4', u'5'])
+			for key, columns in self.trials():
+				self.assertTrial(store.trial(key), columns)
+			self.assertEqual(list(store.column(u'aoi')), [u'face', u'left', \
+				u'notAOI', u'a much longer name', u'été', u'face'])
+			self.assertEqual(store.column(u'fixcount').dtype.kind, u'i')
+		# every string is stored once
+		self.assertEqual(len(store.strings[u'aoi']), 5)
+
+	def test_append(self):
+
+		"""Trials that are appended after reopening add to the store, and
+		to its string tables"""
+
+		trials = self.trials()
+		store = self.lib.columnstore(self.path)
+		store.append(*trials[0])
+		store = self.lib.columnstore(self.path)
+		store.append(*trials[2])
+		store = self.lib.columnstore(self.path)
+		self.assertEqual(store.keys(), [u'3', u'5'])
+		self.assertTrial(store.trial(3), trials[0][1])
+		self.assertTrial(store.trial(5), trials[2][1])
+
+	def test_new(self):
+
+		"""A new store replaces an existing one"""
+
+		trials = self.trials()
+		store = self.lib.columnstore(self.path)
+		store.append(*trials[0])
+		store = self.lib.columnstore(self.path, new=True)
+		self.assertEqual(store.keys(), [])
+		store.append(*trials[0])
+		store = self.lib.columnstore(self.path)
+		self.assertEqual(store.keys(), [u'3'])
+		self.assertTrial(store.trial(3), trials[0][1])
+
+	def test_interrupted(self):
+
+		"""Rows of an append that did not finish are dropped"""
+
+		trials = self.trials()
+		store = self.lib.columnstore(self.path)
+		store.append(*trials[0])
+		f = open(os.path.join(self.path, u'dwell.bin'), u'ab')
+		numpy.zeros(3).tofile(f)
+		f.close()
+		store = self.lib.columnstore(self.path)
+		store.append(*trials[2])
+		self.assertTrial(store.trial(3), trials[0][1])
+		self.assertTrial(store.trial(5), trials[2][1])
+
+	def test_errors(self):
+
+		"""Duplicate keys, and columns that differ, are refused"""
+
+		trials = self.trials()
+		store = self.lib.columnstore(self.path)
+		store.append(*trials[0])
+		self.assertRaises(ValueError, store.append, *trials[0])
+		self.assertRaises(ValueError, store.append, 6, {u'aoi': [u'a']})
+		self.assertRaises(ValueError, store.append, 6, {u'aoi': [u'a'], \
+			u'dwell': [1., 2.], u'fixcount': [1]})
+		self.assertRaises(ValueError, store.append, 6, {u'aoi': [u'a\nb'], \
+			u'dwell': [1.], u'fixcount': [1]})
+
+
+@unittest.skipIf(libfrl is None, u'libfrl needs PyGame')
+class frlcolumnstoretest(columnstoretest):
+
+	"""Tests libfrl.columnstore, which is a copy of libaoi.columnstore"""
+
+	lib = libfrl
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,180 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Regression tests for the built-in fixation detectors: a fixed gaze signal
+# is detected in one go, and in chunks of several sizes, which should give
+# the same fixations.
+#
+#	python -m unittest discover tests
+
+import os
+import sys
+import unittest
+import numpy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'aoi'))
+import libaoi
+
+
+def gazesignal(rate=1000, seed=0):
+
+	"""Returns a fixed gaze signal, as (timestamp, x, y) rows, and the number
+	and the positions of its fixations; the fixations are joined by fast
+	saccades, and one of them is interrupted by missing samples
+
+	keyword arguments
+	rate		--	the sample rate in Hz; the signal is polled at 1 kHz,
+				so that lower rates repeat samples (default = 1000)
+	seed		--	the seed of the noise (default = 0)
+	"""
+
+	random = numpy.random.RandomState(seed)
+	targets = random.uniform(100, 900, size=(24,2))
+	durations = random.randint(150, 400, size=len(targets))
+	rows = []
+	t = 0
+	previous = targets[0]
+	for i in range(len(targets)):
+		# a 20 ms saccade from the previous target
+		for k in range(20):
+			rows.append((t, previous + (targets[i]-previous) * k / 20.0))
+			t += 1
+		for k in range(durations[i]):
+			rows.append((t, targets[i] + random.normal(0, 0.5, size=2)))
+			t += 1
+		previous = targets[i]
+	samples = numpy.array([(t, x, y) for t, (x, y) in rows])
+	# 20 ms of missing samples in the middle of the longest fixation split
+	# it in two
+	i = durations.argmax()
+	middle = 20*(i+1) + durations[:i].sum() + durations[i] // 2
+	samples[middle-10:middle+10,1:] = numpy.nan
+	# samples that the tracker updates less often than they are polled
+	if rate < 1000:
+		updates = numpy.floor(samples[:,0] * rate / 1000.0) * 1000.0 / rate
+		samples[:,1:] = samples[numpy.searchsorted(samples[:,0], updates),1:]
+
+	return samples, targets
+
+
+class fixationdetectortest(unittest.TestCase):
+
+	"""Tests the fixationdetector"""
+
+	def detect(self, samples, method, chunksize):
+
+		"""Returns the events of a detector that gets the samples in chunks
+		of chunksize samples"""
+
+		detector = libaoi.fixationdetector(method, mindur=100)
+		events = []
+		for i in range(0, len(samples), chunksize):
+			events.extend(detector.update(samples[i:i+chunksize]))
+
+		return events + detector.flush()
+
+	def assertSameEvents(self, events, expected):
+
+		"""Checks that two lists of events are the same, up to rounding of
+		the mean positions"""
+
+		self.assertEqual([(t, kind) for t, kind, pos in events], \
+			[(t, kind) for t, kind, pos in expected])
+		if len(events) > 0:
+			numpy.testing.assert_allclose( \
+				[pos for t, kind, pos in events], \
+				[pos for t, kind, pos in expected], rtol=1e-9)
+
+	def test_chunks(self):
+
+		"""Chunked detection gives the same events as detection in one go"""
+
+		for rate in [1000, 60]:
+			samples = gazesignal(rate)[0]
+			for method in [libaoi.IVT, libaoi.IDT]:
+				expected = self.detect(samples, method, len(samples))
+				for chunksize in [1, 7, 16, 100, 1023, 1024, 1025, 5000]:
+					if method == libaoi.IDT and chunksize == 1:
+						# one sample per update is slow for I-DT
+						continue
+					self.assertSameEvents(self.detect(samples, method, \
+						chunksize), expected)
+
+	def test_fixations(self):
+
+		"""Every fixation of the signal is found once (the one with missing
+		samples twice), at its target"""
+
+		for rate in [1000, 60]:
+			samples, targets = gazesignal(rate)
+			for method in [libaoi.IVT, libaoi.IDT]:
+				fixations = libaoi.detect_fixations(samples, method)
+				self.assertEqual(len(fixations), len(targets)+1)
+				# the nearest target of every fixation
+				distance = numpy.hypot( \
+					fixations[:,3:4] - targets[numpy.newaxis,:,0], \
+					fixations[:,4:5] - targets[numpy.newaxis,:,1])
+				self.assertTrue((distance.min(axis=1) < 5).all())
+				self.assertEqual(list(numpy.unique(distance.argmin(axis=1))), \
+					list(range(len(targets))))
+				self.assertTrue((fixations[:,2] >= 100).all())
+
+	def test_missing(self):
+
+		"""Missing samples end fixations, and never start one"""
+
+		samples = gazesignal()[0]
+		gap = numpy.flatnonzero(numpy.isnan(samples[:,1]))
+		for method in [libaoi.IVT, libaoi.IDT]:
+			fixations = libaoi.detect_fixations(samples, method)
+			inside = (fixations[:,0] <= samples[gap[0],0]) & \
+				(fixations[:,1] >= samples[gap[0],0])
+			self.assertFalse(inside.any())
+
+	def test_empty(self):
+
+		"""Empty chunks and recordings give no events"""
+
+		for method in [libaoi.IVT, libaoi.IDT]:
+			detector = libaoi.fixationdetector(method)
+			self.assertEqual(detector.update(numpy.zeros((0,3))), [])
+			self.assertEqual(detector.flush(), [])
+			self.assertEqual(libaoi.detect_fixations(numpy.zeros((0,3)), \
+				method).shape, (0,5))
+
+
+class rangetest(unittest.TestCase):
+
+	"""Tests the sparse range tables of I-DT"""
+
+	def test_range(self):
+
+		"""Table ranges are those of the windows themselves"""
+
+		values = numpy.random.RandomState(1).normal(size=1000)
+		table = libaoi._rangetable(values)
+		first = numpy.arange(0, 900, 3)
+		last = first + numpy.arange(len(first)) % 97
+		ranges = libaoi._range(table, first, last)
+		for i in range(len(first)):
+			window = values[first[i]:last[i]+1]
+			self.assertEqual(ranges[i], window.max() - window.min())
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,187 @@
+"""
+This file is part of OpenSesame.
+
+OpenSesame is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+OpenSesame is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Tests of the AOI hit-test engines: the grid and raster indexes, and
+# templates that are placed with an offset and a scale, should find the
+# same AOIs as testing every AOI.
+#
+#	python -m unittest discover tests
+
+import os
+import sys
+import unittest
+import numpy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'aoi'))
+import libaoi
+
+RESOLUTION = 800, 600
+
+
+def aoidict(n=60, seed=0):
+
+	"""Returns a dict of n overlapping rectangle, ellipse, and polygon AOIs,
+	some of which extend beyond the display
+
+	keyword arguments
+	n		--	the number of AOIs (default = 60)
+	seed		--	the seed of the AOI positions (default = 0)
+	"""
+
+	random = numpy.random.RandomState(seed)
+	aois = {}
+	for i in range(n):
+		x, y = random.randint(-50, 750), random.randint(-50, 550)
+		w, h = random.randint(5, 200), random.randint(5, 200)
+		if i % 3 == 0:
+			aois[u'rect%d' % i] = [x, y, w, h]
+		elif i % 3 == 1:
+			aois[u'ellipse%d' % i] = [u'ellipse', x, y, w, h]
+		else:
+			aois[u'polygon%d' % i] = [u'polygon', [(x, y), (x+w, y+h//3), \
+				(x+w//2, y+h), (x+w//4, y+h//2)]]
+
+	return aois
+
+
+def positions(n=2000, seed=1):
+
+	"""Returns positions in and around the display, as (x,y) rows: random
+	ones, whole pixels, and missing ones
+
+	keyword arguments
+	n		--	the number of random positions (default = 2000)
+	seed		--	the seed of the positions (default = 1)
+	"""
+
+	random = numpy.random.RandomState(seed)
+	w, h = RESOLUTION
+
+	return numpy.vstack((random.uniform(-100, w+100, size=(n,2)), \
+		random.randint(-100, h+100, size=(n,2)), \
+		[(numpy.nan, 100), (100, numpy.nan)]))
+
+
+class indextest(unittest.TestCase):
+
+	"""Tests the hit-test engines against bruteforce"""
+
+	def setUp(self):
+
+		self.aois = libaoi.aoiset(aoidict())
+		self.expected = libaoi.bruteforce(self.aois)
+
+	def assertSameHits(self, index, expected, points, transform=None):
+
+		"""Checks that two hit-test engines find the same AOIs"""
+
+		for fx, fy in points:
+			if transform == None:
+				ex, ey = fx, fy
+			else:
+				ex, ey = transform(fx, fy)
+			self.assertEqual(sorted(index.hits(fx, fy)), \
+				sorted(expected.hits(ex, ey)), (fx, fy))
+
+	def test_bruteforce(self):
+
+		"""The AOI set finds the AOIs that contain a position"""
+
+		aois = libaoi.aoiset({u'a': [0, 0, 20, 20], u'b': [u'ellipse', 0, \
+			0, 20, 20], u'c': [u'polygon', [(0, 0), (20, 0), (0, 20)]], \
+			u'd': [30, 30, 10, 10]})
+		names = [aois.names[i] for i in libaoi.bruteforce(aois).hits(5, 5)]
+		self.assertEqual(sorted(names), [u'a', u'b', u'c'])
+		names = [aois.names[i] for i in libaoi.bruteforce(aois).hits(18, 18)]
+		self.assertEqual(sorted(names), [u'a'])
+		self.assertEqual(len(libaoi.bruteforce(aois).hits(25, 5)), 0)
+
+	def test_grid(self):
+
+		"""The grid index finds the same AOIs"""
+
+		for cellsize in [None, 8, 37, 1000]:
+			index = libaoi.gridindex(self.aois, RESOLUTION, cellsize=cellsize)
+			self.assertSameHits(index, self.expected, positions())
+
+	def test_raster(self):
+
+		"""A raster with a scale of 1 finds the same AOIs at whole pixels,
+		and a coarser one those at the centre of its cells"""
+
+		index = libaoi.rasterindex(self.aois, RESOLUTION)
+		points = numpy.floor(positions())
+		self.assertSameHits(index, self.expected, points)
+		index = libaoi.rasterindex(self.aois, RESOLUTION, scale=4)
+		points = numpy.floor(positions() / 4) * 4 + 1.5
+		self.assertSameHits(index, self.expected, points)
+
+	def test_placed(self):
+
+		"""A placed template finds the same AOIs as a transformed copy of
+		the template"""
+
+		origin = RESOLUTION[0] / 2.0, RESOLUTION[1] / 2.0
+		for dx, dy, scale in [(0, 0, 1), (35.5, -20, 1), (-100, 60, 0.5), \
+			(12, 7, 1.75)]:
+			placed = libaoi.bruteforce(self.aois.transformed(dx, dy, scale, \
+				origin))
+			for index in [self.expected, libaoi.gridindex(self.aois, \
+				RESOLUTION)]:
+				self.assertSameHits(libaoi.placedindex(index, dx, dy, \
+					scale, origin), placed, positions(500))
+			# a raster is accurate to one of its cells, so that it is only
+			# compared at whole pixels of the template
+			index = libaoi.placedindex(libaoi.rasterindex(self.aois, \
+				RESOLUTION), dx, dy, scale, origin)
+			points = numpy.floor(positions(500)) * scale + \
+				(index.shiftx, index.shifty)
+			self.assertSameHits(index, self.expected, points, \
+				transform=index.position)
+		self.assertRaises(ValueError, libaoi.placedindex, self.expected, \
+			scale=0)
+
+	def test_classify(self):
+
+		"""classify counts the fixations that bruteforce finds, except for
+		those with a missing position"""
+
+		points = positions()
+		durations = numpy.arange(len(points), dtype=float)
+		counts, dwell, labels = libaoi.classify(self.aois, points, \
+			durations, chunksize=333)
+		expected = numpy.zeros(len(self.aois), dtype=int)
+		expecteddwell = numpy.zeros(len(self.aois))
+		for i in range(len(points)):
+			if numpy.isfinite(points[i]).all():
+				hits = self.expected.hits(*points[i])
+			else:
+				hits = numpy.zeros(0, dtype=int)
+			expected[hits] += 1
+			expecteddwell[hits] += durations[i]
+			if len(hits) == 0:
+				self.assertEqual(labels[i], -1)
+			else:
+				self.assertEqual(labels[i], min(hits))
+		numpy.testing.assert_array_equal(counts, expected)
+		numpy.testing.assert_allclose(dwell, expecteddwell)
+
+
+if __name__ == '__main__':
+	unittest.main()